@@ -0,0 +1,292 @@
+import os
+import sys
+import json
+import time
+import Queue
+import random
+import tempfile
+import platform
+import argparse
+import resource
+import traceback
+import multiprocessing
+
+import KB
+import ReadVector
+import Instrument
+import SizeAlgorithm
+
+###
+### Benchmarks for the size and evaluation pipeline on synthetic data.
+###
+### python Benchmark.py --scales 1000,10000,100000 --out results.json
+### python Benchmark.py --compare old.json results.json
+###
+
+MOD_TYPES = [('over', 0), ('over', 1), (('ind', 'x'), 0), (('ind', 'x'), 1), (('ind', 'y'), 0), (('ind', 'y'), 1)]
+COLOURS = ['red', 'orange', 'yellow', 'green', 'blue', 'purple', 'pink', 'black', 'brown', 'grey', 'white']
+
+# Stages timed for each scale: name -> function(n, seed, tmp_dir) returning
+# (a function that runs the stage once the setup is done, number of items
+# it processes).
+STAGES = {}
+
+# Seconds a stage may run before it is recorded as failed.
+TIMEOUT = 3600
+
+
+def make_corpus(n, seed=0, n_supertypes=10, max_expressions=5):
+    """
+    Synthetic size_hash/observed_hash with n referents, in the formats
+    described in SizeAlgorithm.__init__.
+    """
+    rnd = random.Random(seed)
+    size_hash = {}
+    observed_hash = {}
+    for i in range(n):
+        supertype = "super%d" % (i % n_supertypes)
+        subtype = str(i)
+        size_hash.setdefault(supertype, {})[subtype] = {'referent': (rnd.randint(1, 30), rnd.randint(1, 30)), \
+                                                        'distractor': (rnd.randint(1, 30), rnd.randint(1, 30))}
+        expressions = {}
+        for expression in range(rnd.randint(1, max_expressions)):
+            expressions[expression] = [rnd.choice(MOD_TYPES) for k in range(rnd.randint(0, 2))]
+        observed_hash.setdefault(supertype, {})[subtype] = expressions
+    return (size_hash, observed_hash)
+
+
+def write_scene(path, n, seed=0):
+    """
+    Synthetic ReadVector scene file with n objects.
+    """
+    rnd = random.Random(seed)
+    fid = open(path, "w")
+    for i in range(n):
+        obj_id = "obj%d" % i
+        fid.write("%s type type%d\n" % (obj_id, rnd.randint(0, 99)))
+        fid.write("%s colour %s\n" % (obj_id, rnd.choice(COLOURS)))
+        fid.write("%s height %d\n" % (obj_id, rnd.randint(1, 30)))
+        fid.write("%s width %d\n" % (obj_id, rnd.randint(1, 30)))
+        fid.write("%s location %s\n" % (obj_id, " ".join(["%d:%d" % (cell, rnd.randint(0, 1)) for cell in range(9)])))
+    fid.close()
+
+
+def write_kb(path, n, seed=0):
+    """
+    Synthetic KB-Data/objects style prototype file with n types.
+    """
+    rnd = random.Random(seed)
+    fid = open(path, "w")
+    for i in range(n):
+        atts = ["colour:%s:%.6f" % (colour, rnd.random()) for colour in COLOURS]
+        atts += ["material:%s:%.6f" % (material, rnd.random()) for material in ('wood', 'metal', 'plastic')]
+        fid.write("type%d %s\n" % (i, " ".join(atts)))
+    fid.close()
+
+
+def size_stage(name):
+    def setup(n, seed, tmp_dir):
+        (size_hash, observed_hash) = make_corpus(n, seed)
+        # Instrumented, so that warnings are counted rather than written to stderr.
+        size_alg = SizeAlgorithm.SizeAlgorithm(size_hash, observed_hash, seed=seed, instrument=Instrument.Stats())
+        if name in ('evaluate', 'stats'):
+            size_alg.predict()
+        return (getattr(size_alg, name), n)
+    STAGES[name] = setup
+
+for name in ('predict', 'oracle_predict', 'maj_predict', 'evaluate', 'stats'):
+    size_stage(name)
+
+
+def read_scene_setup(compact):
+    def setup(n, seed, tmp_dir):
+        path = os.path.join(tmp_dir, "scene")
+        write_scene(path, n, seed)
+        return (lambda: ReadVector.Read(path, compact=compact), n)
+    return setup
+
+STAGES['read_scene'] = read_scene_setup(False)
+STAGES['read_scene_compact'] = read_scene_setup(True)
+
+
+def read_kb_setup(cache):
+    def setup(n, seed, tmp_dir):
+        # One prototype per 100 referents.
+        path = os.path.join(tmp_dir, "objects")
+        num_types = max(1, n // 100)
+        write_kb(path, num_types, seed)
+        if cache:
+            KB.Prototypes(path)
+        return (lambda: KB.Prototypes(path, cache=cache), num_types)
+    return setup
+
+STAGES['read_kb'] = read_kb_setup(False)
+STAGES['read_kb_cached'] = read_kb_setup(True)
+
+
+def proc_status_kb(field):
+    # A memory field (e.g. 'VmRSS', 'VmHWM') of /proc/self/status in KB, or None off Linux.
+    try:
+        fid = open("/proc/self/status")
+        lines = fid.readlines()
+        fid.close()
+    except IOError:
+        return None
+    for line in lines:
+        if line.startswith(field + ":"):
+            return int(line.split()[1])
+    return None
+
+
+def reset_peak_rss():
+    # Resets the process's peak RSS (VmHWM) to its current RSS; Linux only.
+    try:
+        fid = open("/proc/self/clear_refs", "w")
+        fid.write("5")
+        fid.close()
+        return True
+    except IOError:
+        return False
+
+
+def run_stage(stage, n, seed, queue):
+    """
+    Runs one stage in this (fresh) process and puts its record on queue.
+    setup_peak_rss_kb is the peak while building the input, start_rss_kb
+    the RSS holding it, peak_rss_kb the peak while the stage ran and
+    stage_rss_kb what the stage added on top of its input.  Where the
+    peak cannot be reset (off Linux), peak_rss_kb includes the setup's.
+    """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        (run, items) = STAGES[stage](n, seed, tmp_dir)
+        setup_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start_rss = proc_status_kb('VmRSS')
+        reset = reset_peak_rss()
+        start = time.time()
+        start_cpu = time.clock()
+        run()
+        seconds = time.time() - start
+        cpu_seconds = time.clock() - start_cpu
+        if reset:
+            peak_rss = proc_status_kb('VmHWM')
+        else:
+            (start_rss, peak_rss) = (setup_rss, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+        queue.put({'stage': stage, 'n': n, 'items': items, 'seconds': seconds, 'cpu_seconds': cpu_seconds, \
+                   'per_second': items / max(seconds, 1e-9), 'setup_peak_rss_kb': setup_rss, 'start_rss_kb': start_rss, \
+                   'peak_rss_kb': peak_rss, 'stage_rss_kb': max(peak_rss - start_rss, 0)})
+    except Exception:
+        queue.put({'stage': stage, 'n': n, 'error': traceback.format_exc()})
+    finally:
+        for name in os.listdir(tmp_dir):
+            os.remove(os.path.join(tmp_dir, name))
+        os.rmdir(tmp_dir)
+
+
+def benchmark(scales, stages=None, seed=0, timeout=TIMEOUT):
+    """
+    Times each stage at each scale, each in a fresh process so that
+    memory use is that stage's own (see run_stage).  Returns the list of
+    run records; a stage that fails or runs past timeout gets an 'error'
+    instead.
+    """
+    if stages is None:
+        stages = sorted(STAGES)
+    runs = []
+    for n in scales:
+        for stage in stages:
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=run_stage, args=(stage, n, seed, queue))
+            process.start()
+            run = wait_run(process, queue, timeout)
+            if run is None:
+                run = {'stage': stage, 'n': n, 'error': "no result (exit code %s)" % process.exitcode}
+            if 'error' in run:
+                sys.stderr.write("%s n=%d failed: %s\n" % (stage, n, run['error']))
+            else:
+                sys.stderr.write("%s n=%d: %.3fs, %.0f/s, peak %d KB (+%d KB over input)\n" % \
+                                 (stage, n, run['seconds'], run['per_second'], run['peak_rss_kb'], run['stage_rss_kb']))
+            runs += [run]
+    return runs
+
+
+def wait_run(process, queue, timeout):
+    # The stage's record, or None if the process died or timed out without one.
+    deadline = time.time() + timeout
+    run = None
+    while run is None and time.time() < deadline:
+        try:
+            run = queue.get(timeout=1)
+        except Queue.Empty:
+            if not process.is_alive():
+                break
+    if run is None and process.is_alive():
+        process.terminate()
+    process.join()
+    return run
+
+
+def write_results(path, runs):
+    results = {'created': time.strftime("%Y-%m-%dT%H:%M:%S"), 'python': platform.python_version(), \
+               'machine': platform.machine(), 'runs': runs}
+    fid = open(path, "w")
+    json.dump(results, fid, indent=1, sort_keys=True)
+    fid.close()
+    return results
+
+
+def compare(old_path, new_path, threshold=0.1):
+    """
+    Prints the stages that got slower or bigger by more than threshold
+    between two results files, that failed in the new one or that are
+    missing from it, and returns them.
+    """
+    old_runs = dict(((run['stage'], run['n']), run) for run in json.load(open(old_path))['runs'])
+    new_runs = dict(((run['stage'], run['n']), run) for run in json.load(open(new_path))['runs'])
+    regressions = []
+    for (stage, n) in sorted(set(old_runs) | set(new_runs)):
+        old_run = old_runs.get((stage, n))
+        run = new_runs.get((stage, n))
+        if run is None:
+            changes = [('missing', None, None)]
+        elif 'error' in run:
+            changes = [('error', old_run and old_run.get('error'), run['error'].strip().split("\n")[-1])]
+        elif old_run is None or 'error' in old_run:
+            continue
+        else:
+            changes = [(key, old_run[key], run[key]) for key in ('seconds', 'peak_rss_kb', 'stage_rss_kb') \
+                       if key in old_run and key in run and run[key] > old_run[key] * (1 + threshold)]
+        for (key, old_val, new_val) in changes:
+            regressions += [(stage, n, key, old_val, new_val)]
+            print "%s n=%d %s: %s -> %s" % (stage, n, key, old_val, new_val)
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmarks the size and evaluation pipeline.")
+    parser.add_argument("--scales", default="1000,10000,100000", help="comma-separated numbers of referents")
+    parser.add_argument("--stages", default=None, help="comma-separated stages (default all): " + ", ".join(sorted(STAGES)))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="benchmark_results.json")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two results files instead")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    parser.add_argument("--timeout", type=float, default=TIMEOUT, help="seconds per stage")
+    args = parser.parse_args(argv)
+    if args.compare:
+        regressions = compare(args.compare[0], args.compare[1], args.threshold)
+        return 1 if regressions else 0
+    stages = None
+    if args.stages:
+        stages = args.stages.split(",")
+        unknown = [stage for stage in stages if stage not in STAGES]
+        if unknown:
+            parser.error("unknown stages: " + ", ".join(unknown))
+    runs = benchmark([int(n) for n in args.scales.split(",")], stages, args.seed, args.timeout)
+    write_results(args.out, runs)
+    if [run for run in runs if 'error' in run]:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,237 @@
+import sys
+import mmap
+import struct
+import cPickle
+import numpy
+
+###
+### Compiled annotation corpus: an observed_hash
+### ({supertype: {subtype: {expression: [(mod_type, polarity) ...]}}})
+### as flat arrays in one file, read through mmap.  Modifier types are
+### interned as small integer codes, and offset arrays (as in a CSR matrix)
+### lead from supertypes to referents, from referents to expressions and
+### from expressions to modifiers:
+###
+###   referents of supertype s      sup_offsets[s] .. sup_offsets[s + 1]
+###   expressions of referent r     ref_offsets[r] .. ref_offsets[r + 1]
+###   modifier codes of expression  mod_offsets[e] .. mod_offsets[e + 1] in mods
+###   its distinct modifier types   type_offsets[e] .. type_offsets[e + 1] in types,
+###                                 in SizeAlgorithm.mod_type_hash order
+###
+### Everything keeps the iteration order of the dicts it was compiled from,
+### so SizeAlgorithm gives the same results on a Corpus as on the dicts.
+###
+### python Corpus.py observed.pickle observed.corpus
+###
+
+MAGIC = "SIZECORP"
+VERSION = 1
+# magic, version, bytes per code, supertypes, referents, expressions,
+# modifiers, distinct-type entries, length of the pickled tables
+HEADER = struct.Struct("<8sIIqqqqqq")
+OFFSET_DTYPE = numpy.dtype("<i8")
+
+
+def code_dtype(num_types):
+    if num_types <= 1 << 8:
+        return numpy.dtype(numpy.uint8)
+    if num_types <= 1 << 16:
+        return numpy.dtype("<u2")
+    return numpy.dtype("<u4")
+
+
+def padding(size):
+    # Keeps every array 8-byte aligned.
+    return "\0" * (-size % 8)
+
+
+def compile_corpus(observed_hash, path):
+    """
+    Writes observed_hash to path in the compiled format.
+    Returns the number of referents written.
+    """
+    mod_types = []
+    codes = {}
+    supertypes = []
+    subtypes = []
+    expressions = []
+    sup_offsets = [0]
+    ref_offsets = [0]
+    mod_offsets = [0]
+    type_offsets = [0]
+    mods = []
+    types = []
+    for supertype in observed_hash:
+        supertypes += [supertype]
+        for subtype in observed_hash[supertype]:
+            subtypes += [subtype]
+            for expression in observed_hash[supertype][subtype]:
+                expressions += [expression]
+                expression_mods = observed_hash[supertype][subtype][expression]
+                for mod in expression_mods:
+                    try:
+                        mods += [codes[mod]]
+                    except KeyError:
+                        codes[mod] = len(mod_types)
+                        mod_types += [mod]
+                        mods += [codes[mod]]
+                # Inserting in list order iterates as mod_type_hash's dict does.
+                types += [codes[mod] for mod in dict.fromkeys(expression_mods)]
+                mod_offsets += [len(mods)]
+                type_offsets += [len(types)]
+            ref_offsets += [len(expressions)]
+        sup_offsets += [len(subtypes)]
+    dtype = code_dtype(len(mod_types))
+    tables = cPickle.dumps((mod_types, supertypes, subtypes), cPickle.HIGHEST_PROTOCOL)
+    fid = open(path, "wb")
+    fid.write(HEADER.pack(MAGIC, VERSION, dtype.itemsize, len(supertypes), len(subtypes), len(expressions), \
+                          len(mods), len(types), len(tables)))
+    for (values, values_dtype) in ((sup_offsets, OFFSET_DTYPE), (ref_offsets, OFFSET_DTYPE), (mod_offsets, OFFSET_DTYPE), \
+                                   (type_offsets, OFFSET_DTYPE), (mods, dtype), (types, dtype)):
+        data = numpy.array(values, dtype=values_dtype).tostring()
+        fid.write(data)
+        fid.write(padding(len(data)))
+    fid.write(tables)
+    # Expression keys are only needed to read expressions back as dicts.
+    cPickle.dump(expressions, fid, cPickle.HIGHEST_PROTOCOL)
+    fid.close()
+    return len(subtypes)
+
+
+class Corpus():
+    """
+    Read-only view of a compiled corpus that iterates and indexes like the
+    observed_hash it was compiled from; corpus[supertype][subtype] decodes
+    that referent's {expression: [(mod_type, polarity) ...]}.
+    """
+    def __init__(self, path):
+        self.path = path
+        fid = open(path, "rb")
+        self.map = mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+        fid.close()
+        (magic, version, code_bytes, num_sups, num_refs, num_exps, num_mods, num_types, tables_len) = \
+            HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a version %d compiled corpus: %s" % (VERSION, path))
+        dtype = numpy.dtype("<u%d" % code_bytes) if code_bytes > 1 else numpy.dtype(numpy.uint8)
+        offset = HEADER.size
+        arrays = []
+        for (count, array_dtype) in ((num_sups + 1, OFFSET_DTYPE), (num_refs + 1, OFFSET_DTYPE), (num_exps + 1, OFFSET_DTYPE), \
+                                     (num_exps + 1, OFFSET_DTYPE), (num_mods, dtype), (num_types, dtype)):
+            arrays += [numpy.frombuffer(self.map, dtype=array_dtype, count=count, offset=offset)]
+            offset += count * array_dtype.itemsize
+            offset += -offset % 8
+        (self.sup_offsets, self.ref_offsets, self.mod_offsets, self.type_offsets, self.mods, self.types) = arrays
+        (self.mod_types, self.supertypes, self.subtypes) = cPickle.loads(self.map[offset:offset + tables_len])
+        self.expressions_at = offset + tables_len
+        self.expression_keys = None
+        self.codes = dict((mod_type, code) for (code, mod_type) in enumerate(self.mod_types))
+        self.sup_index = dict((supertype, s) for (s, supertype) in enumerate(self.supertypes))
+        # {supertype number : {subtype : referent number}}, filled on demand.
+        self.ref_index = {}
+
+    def __iter__(self):
+        return iter(self.supertypes)
+
+    def __len__(self):
+        return len(self.supertypes)
+
+    def __contains__(self, supertype):
+        return supertype in self.sup_index
+
+    def __getitem__(self, supertype):
+        return Referents(self, self.sup_index[supertype])
+
+    def keys(self):
+        return list(self.supertypes)
+
+    def referents(self):
+        """
+        (referent number, supertype, subtype) for every referent, in order.
+        """
+        for (s, supertype) in enumerate(self.supertypes):
+            for r in range(self.sup_offsets[s], self.sup_offsets[s + 1]):
+                yield (r, supertype, self.subtypes[r])
+
+    def referent_index(self, s):
+        try:
+            return self.ref_index[s]
+        except KeyError:
+            start = int(self.sup_offsets[s])
+            subtypes = self.subtypes[start:int(self.sup_offsets[s + 1])]
+            index = self.ref_index[s] = dict((subtype, start + n) for (n, subtype) in enumerate(subtypes))
+            return index
+
+    def expressions(self, r):
+        """
+        {expression: [(mod_type, polarity) ...]} of referent r.
+        """
+        if self.expression_keys is None:
+            self.expression_keys = cPickle.loads(self.map[self.expressions_at:])
+        expressions = {}
+        for e in range(self.ref_offsets[r], self.ref_offsets[r + 1]):
+            codes = self.mods[self.mod_offsets[e]:self.mod_offsets[e + 1]].tolist()
+            expressions[self.expression_keys[e]] = [self.mod_types[code] for code in codes]
+        return expressions
+
+    def entries(self):
+        """
+        (referent, expression, code) arrays with one entry per distinct
+        modifier type of each expression, in expression order.
+        """
+        exp_refs = numpy.repeat(numpy.arange(len(self.subtypes)), numpy.diff(self.ref_offsets))
+        ent_exps = numpy.repeat(numpy.arange(len(exp_refs)), numpy.diff(self.type_offsets))
+        return (exp_refs[ent_exps], ent_exps, self.types.astype(int))
+
+    def close(self):
+        """
+        Drops this corpus's arrays and its map.  The file is unmapped once
+        nothing else holds an array read from it, so arrays taken from the
+        corpus (e.g. by entries) stay valid.
+        """
+        (self.sup_offsets, self.ref_offsets, self.mod_offsets, self.type_offsets, self.mods, self.types) = (None,) * 6
+        self.map = None
+
+
+class Referents():
+    """
+    {subtype : expressions} view of one supertype of a Corpus.
+    """
+    def __init__(self, corpus, s):
+        self.corpus = corpus
+        self.s = s
+
+    def __iter__(self):
+        start = int(self.corpus.sup_offsets[self.s])
+        return iter(self.corpus.subtypes[start:int(self.corpus.sup_offsets[self.s + 1])])
+
+    def __len__(self):
+        return int(self.corpus.sup_offsets[self.s + 1] - self.corpus.sup_offsets[self.s])
+
+    def __contains__(self, subtype):
+        return subtype in self.corpus.referent_index(self.s)
+
+    def __getitem__(self, subtype):
+        return self.corpus.expressions(self.corpus.referent_index(self.s)[subtype])
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(subtype, self[subtype]) for subtype in self]
+
+
+def main(argv):
+    if len(argv) != 2:
+        sys.stderr.write("Usage: python Corpus.py observed.pickle observed.corpus\n")
+        return 1
+    fid = open(argv[0], "rb")
+    observed_hash = cPickle.load(fid)
+    fid.close()
+    num_referents = compile_corpus(observed_hash, argv[1])
+    sys.stderr.write("Compiled %d referents to %s\n" % (num_referents, argv[1]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,107 @@
+import sys
+import time
+import functools
+
+###
+### Optional instrumentation: event counters and per-stage wall/CPU timers.
+### Code being instrumented holds either a Stats or None; with None the
+### counters are skipped, timed methods run directly and timer() hands
+### back a shared do-nothing timer.
+###
+
+class Stats():
+    def __init__(self):
+        # {event : number of times seen}, e.g. decision branches and warnings.
+        self.counts = {}
+        # {stage : [calls, wall seconds, CPU seconds]}
+        self.stages = {}
+
+    def count(self, event, n=1):
+        self.counts[event] = self.counts.get(event, 0) + n
+
+    def timer(self, stage):
+        return Timer(self, stage)
+
+    def add_time(self, stage, wall, cpu):
+        try:
+            times = self.stages[stage]
+        except KeyError:
+            times = self.stages[stage] = [0, 0.0, 0.0]
+        times[0] += 1
+        times[1] += wall
+        times[2] += cpu
+
+    def merge(self, other):
+        for event in other.counts:
+            self.count(event, other.counts[event])
+        for stage in other.stages:
+            (calls, wall, cpu) = other.stages[stage]
+            self.add_time(stage, wall, cpu)
+            self.stages[stage][0] += calls - 1
+        return self
+
+    def as_dict(self):
+        """
+        {'counts': {event: n}, 'stages': {stage: {'calls', 'wall', 'cpu'}}}
+        """
+        stages = {}
+        for stage in self.stages:
+            (calls, wall, cpu) = self.stages[stage]
+            stages[stage] = {'calls': calls, 'wall': wall, 'cpu': cpu}
+        return {'counts': dict(self.counts), 'stages': stages}
+
+
+class Timer():
+    def __init__(self, stats, stage):
+        self.stats = stats
+        self.stage = stage
+
+    def __enter__(self):
+        self.wall = time.time()
+        self.cpu = time.clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stats.add_time(self.stage, time.time() - self.wall, time.clock() - self.cpu)
+        return False
+
+
+class NoTimer():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+NO_TIMER = NoTimer()
+
+
+def timer(stats, stage):
+    if stats is None:
+        return NO_TIMER
+    return stats.timer(stage)
+
+
+def timed(stage):
+    """
+    Method decorator timing calls under stage in self.instrument, if set.
+    """
+    def decorate(method):
+        @functools.wraps(method)
+        def timed_method(self, *args, **kwargs):
+            if self.instrument is None:
+                return method(self, *args, **kwargs)
+            with self.instrument.timer(stage):
+                return method(self, *args, **kwargs)
+        return timed_method
+    return decorate
+
+
+def warn(stats, event, message, n=1):
+    """
+    Counts event (n times) when instrumented; otherwise writes message to stderr.
+    """
+    if stats is None:
+        sys.stderr.write(message * n)
+    else:
+        stats.count(event, n)
@@ -1,4 +1,20 @@
+import os
 import sys
+import hashlib
+import tempfile
+import cPickle
+import cStringIO
+import numpy
+
+# Default prototype KB; the KB_OBJECTS environment variable overrides it.
+KB_PATH = os.environ.get("KB_OBJECTS", os.path.join(os.path.dirname(os.path.abspath(__file__)), "KB-Data", "objects"))
+
+# Compiled snapshots are written next to the source file with this suffix.
+CACHE_SUFFIX = ".cache"
+CACHE_VERSION = 1
+
+# Process-wide instances, by KB path; see shared_prototypes.
+shared = {}
 
 class Size():
     def __init__(self, expression):
@@ -17,16 +33,85 @@ class Size():
             self.lemma = "fat"
 
 class Prototypes():
-    def __init__(self):
-        fid = open("KB-Data/objects", "r")
-        in_file = fid.readlines()
-        fid.close()
-        self.protohash = {}
-        self.read(in_file)
+    def __init__(self, path=None, cache=True):
+        """
+        Reads the prototype KB at path (default KB_PATH).  With cache=True,
+        loads the compiled snapshot if it is still up to date with the
+        source file, and otherwise re-parses the source and rewrites it.
+        """
+        if path is None:
+            path = KB_PATH
+        self.path = path
+        self.protohash = None
+        if cache:
+            self.load_cache()
+        if self.protohash is None:
+            (key, digest, data) = self.read_source()
+            self.protohash = {}
+            self.read(cStringIO.StringIO(data).readlines())
+            if cache:
+                self.write_cache(key, digest)
         self.implies = {}
         self.interconnections = {}
         self.read_interconnections()
 
+    def source_key(self):
+        stat = os.stat(self.path)
+        return (stat.st_mtime, stat.st_size)
+
+    def read_source(self):
+        """
+        Returns (key, digest, data) for the source file, all from one open,
+        so that a snapshot is saved under the key and digest of the bytes
+        that were parsed.  The key is taken before reading: a change made
+        while reading leaves it out of date, and the next load re-checks.
+        """
+        fid = open(self.path, "rb")
+        stat = os.fstat(fid.fileno())
+        data = fid.read()
+        fid.close()
+        return ((stat.st_mtime, stat.st_size), hashlib.sha1(data).hexdigest(), data)
+
+    def load_cache(self):
+        try:
+            fid = open(self.path + CACHE_SUFFIX, "rb")
+            (version, key, digest, protohash) = cPickle.load(fid)
+            fid.close()
+        except (IOError, EOFError, ValueError, TypeError, cPickle.UnpicklingError):
+            return None
+        if version != CACHE_VERSION:
+            return None
+        if key != self.source_key():
+            # Touched but maybe not changed: check the contents.
+            (source_key, source_digest, data) = self.read_source()
+            if digest != source_digest:
+                return None
+            self.protohash = protohash
+            self.write_cache(source_key, digest)
+            return self.protohash
+        self.protohash = protohash
+        return self.protohash
+
+    def write_cache(self, key, digest):
+        # Written under a temporary name and renamed over the snapshot, so that
+        # concurrent readers see either the old or the new one, never a partial one.
+        try:
+            (handle, tmp_path) = tempfile.mkstemp(prefix=os.path.basename(self.path) + CACHE_SUFFIX + ".", \
+                                                  dir=os.path.dirname(os.path.abspath(self.path)))
+        except (IOError, OSError):
+            sys.stderr.write("Could not write KB cache " + self.path + CACHE_SUFFIX + "\n")
+            return None
+        try:
+            fid = os.fdopen(handle, "wb")
+            cPickle.dump((CACHE_VERSION, key, digest, self.protohash), fid, cPickle.HIGHEST_PROTOCOL)
+            fid.close()
+            os.rename(tmp_path, self.path + CACHE_SUFFIX)
+        except (IOError, OSError):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            # Read-only KB directory: work without the snapshot.
+            sys.stderr.write("Could not write KB cache " + self.path + CACHE_SUFFIX + "\n")
+
     def read(self, in_file):
         for line in in_file:
             split_line = line.split()
@@ -52,6 +137,33 @@ class Prototypes():
         except KeyError:
             return None
 
+    def typicality(self, object):
+        """
+        Returns ({att: prototype probability of the object's value}, most
+        atypical att) over the object's attributes that its prototype has.
+        A value the prototype has never seen scores 0.0.  Ties for the most
+        atypical attribute go to the first in sorted order.
+        """
+        prototype = self.find_category(object)
+        scores = {}
+        if prototype is None:
+            return (scores, None)
+        for att in object:
+            if att == 'type' or att not in prototype:
+                continue
+            scores[att] = prototype[att].get(object[att], 0.0)
+        atypical = None
+        for att in sorted(scores):
+            if atypical is None or scores[att] < scores[atypical]:
+                atypical = att
+        return (scores, atypical)
+
+    def compile_matrix(self):
+        return PrototypeMatrix(self)
+
+    def compile_implications(self):
+        return Implications(self)
+
     def read_interconnections(self):
         self.interconnections['material'] = ('colour', 'texture', 'sheen', 'opacity')
         self.interconnections['shape'] = ('form', 'height/width')
@@ -59,3 +171,183 @@ class Prototypes():
         self.implies[('material', 'wood')] = {'colour':('tan', 'brown', 'dark-tan', 'light-tan', 'light-brown'), 'texture':('smooth',), 'sheen':1, 'opacity':3}
         self.implies[('material', 'metal')] = {'colour':('silver', 'brass', 'gold'), 'texture':('smooth',), 'sheen':2, 'opacity':3}
 
+
+
+class PrototypeMatrix():
+    """
+    Dense type x (attribute, value) matrix of prototype probabilities,
+    for scoring many objects against their prototypes at once.
+    """
+    def __init__(self, prototypes):
+        protohash = prototypes.protohash
+        self.types = sorted(protohash)
+        self.type_index = dict((obj_type, n) for (n, obj_type) in enumerate(self.types))
+        columns = set()
+        for obj_type in protohash:
+            for att in protohash[obj_type]:
+                if att == 'type':
+                    continue
+                for val in protohash[obj_type][att]:
+                    columns.add((att, val))
+        self.columns = sorted(columns)
+        self.column_index = dict((column, n) for (n, column) in enumerate(self.columns))
+        self.attributes = sorted(set([att for (att, val) in self.columns]))
+        self.att_index = dict((att, n) for (n, att) in enumerate(self.attributes))
+        self.probs = numpy.zeros((len(self.types), len(self.columns)))
+        # Whether each type's prototype has each attribute at all.
+        self.has_att = numpy.zeros((len(self.types), len(self.attributes)), dtype=bool)
+        for obj_type in protohash:
+            row = self.type_index[obj_type]
+            for att in protohash[obj_type]:
+                if att == 'type':
+                    continue
+                self.has_att[row, self.att_index[att]] = True
+                for val in protohash[obj_type][att]:
+                    self.probs[row, self.column_index[(att, val)]] = protohash[obj_type][att][val]
+
+    def typicality(self, objects):
+        """
+        Batch version of Prototypes.typicality: returns (scores, atypical),
+        lists with one {att: prob} dict and one most atypical att per object.
+        """
+        obj_nums = []
+        rows = []
+        atts = []
+        cols = []
+        for (n, object) in enumerate(objects):
+            try:
+                row = self.type_index[object['type']]
+            except KeyError:
+                continue
+            for att in object:
+                if att == 'type' or att not in self.att_index:
+                    continue
+                obj_nums += [n]
+                rows += [row]
+                atts += [self.att_index[att]]
+                # Values no prototype has are scored from an all-zero column.
+                cols += [self.column_index.get((att, object[att]), -1)]
+        scores = [{} for object in objects]
+        atypical = [None] * len(objects)
+        if obj_nums == []:
+            return (scores, atypical)
+        obj_nums = numpy.array(obj_nums)
+        rows = numpy.array(rows)
+        atts = numpy.array(atts)
+        cols = numpy.array(cols)
+        known = self.has_att[rows, atts]
+        probs = numpy.where(cols >= 0, self.probs[rows, numpy.maximum(cols, 0)], 0.0)
+        (obj_nums, atts, probs) = (obj_nums[known], atts[known], probs[known])
+        for (n, att, prob) in zip(obj_nums.tolist(), atts.tolist(), probs.tolist()):
+            scores[n][self.attributes[att]] = prob
+        # Lowest probability per object, ties to the first attribute in sorted order.
+        order = numpy.lexsort((atts, probs, obj_nums))
+        first = numpy.ones(len(order), dtype=bool)
+        first[1:] = obj_nums[order][1:] != obj_nums[order][:-1]
+        for (n, att) in zip(obj_nums[order][first].tolist(), atts[order][first].tolist()):
+            atypical[n] = self.attributes[att]
+        return (scores, atypical)
+
+
+class Implications():
+    """
+    Transitive closure of Prototypes.implies and Prototypes.interconnections,
+    computed once so that checking an attribute does not depend on the length
+    of the chain that implies it.
+    implies maps an (att, val) to the values it allows for other attributes;
+    only attributes that interconnections connect to att, directly or
+    through others, are constrained.  An attribute is implied when the
+    values allowed for it narrow to just the object's value, and only such
+    fully determined values imply further.
+    """
+    def __init__(self, prototypes):
+        self.connected = {}
+        for att in prototypes.interconnections:
+            self.connected[att] = self.reach(prototypes.interconnections, att)
+        self.closure = {}
+        for fact in prototypes.implies:
+            self.closure[fact] = self.close(prototypes.implies, fact)
+
+    def close(self, implies, fact):
+        # {att : frozenset of allowed values} reachable from fact.
+        allowed = {}
+        queue = [fact]
+        seen = set(queue)
+        while queue != []:
+            (fact_att, fact_val) = queue.pop()
+            connected = self.connected.get(fact_att, frozenset())
+            for (att, spec) in implies.get((fact_att, fact_val), {}).items():
+                if att not in connected:
+                    continue
+                vals = set([value_key(val) for val in allowed_values(spec)])
+                if att in allowed:
+                    vals &= allowed[att]
+                allowed[att] = vals
+                if len(vals) == 1:
+                    implied = (att, list(vals)[0])
+                    if implied not in seen:
+                        seen.add(implied)
+                        queue += [implied]
+        return dict((att, frozenset(allowed[att])) for att in allowed)
+
+    def reach(self, interconnections, att):
+        # All attributes connected to att, directly or through others.
+        connected = set()
+        queue = list(interconnections.get(att, ()))
+        while queue != []:
+            other = queue.pop()
+            if other not in connected:
+                connected.add(other)
+                queue += list(interconnections.get(other, ()))
+        return frozenset(connected)
+
+    def implied(self, object):
+        """
+        Returns the set of the object's attributes implied by its other
+        attributes, which a description can skip.  Attributes are checked in
+        sorted order and one already skipped does not imply others, so of
+        two attributes that imply each other only one is skipped.
+        """
+        facts = [(att, value_key(object[att])) for att in sorted(object) if att != 'type']
+        skipped = set()
+        for (att, val) in facts:
+            for (other, other_val) in facts:
+                if other == att or other in skipped:
+                    continue
+                allowed = self.closure.get((other, other_val))
+                if allowed is not None and allowed.get(att) == frozenset([val]):
+                    skipped.add(att)
+                    break
+        return skipped
+
+    def implied_batch(self, objects):
+        return [self.implied(object) for object in objects]
+
+
+def allowed_values(spec):
+    if isinstance(spec, (tuple, list, set, frozenset)):
+        return spec
+    return (spec,)
+
+
+def value_key(val):
+    # KB values and scene values ('1', 1, 1.0) compare as the same string.
+    # Strings are kept as they are: str() of a non-ASCII unicode value fails.
+    if isinstance(val, basestring):
+        return val
+    if isinstance(val, float) and val == int(val):
+        val = int(val)
+    return str(val)
+
+
+def shared_prototypes(path=None):
+    """
+    Returns the process-wide Prototypes for path (default KB_PATH),
+    loading it on first use.
+    """
+    if path is None:
+        path = KB_PATH
+    path = os.path.abspath(path)
+    if path not in shared:
+        shared[path] = Prototypes(path)
+    return shared[path]
@@ -1,27 +1,527 @@
 import sys
 import re
+import heapq
+import itertools
+import numpy
+import Instrument
+
+# Bytes read at a time by the streaming readers.
+BUFFER_SIZE = 65536
+# GridIndex buckets centroids in a grid of this many buckets per side.
+CENTROID_RESOLUTION = 32
 
 class Read():
-    def __init__(self, fid):
-        in_fid = open(fid, "r")
-        self.in_file = in_fid.readlines()
-        in_fid.close()
-        self.scene = {}
-        self.read_scene()
+    def __init__(self, fid, compact=False, instrument=None):
+        """
+        Reads a scene file of lines "obj_id feature value" or, for 9-cell grid
+        features, "obj_id feature 0:val 1:val ... 8:val".
+        With compact=True, self.scene is a columnar Scene rather than a dict,
+        holding the same (string) values.
+        Parsing is timed as stage 'parse' in instrument (an Instrument.Stats), if given.
+        """
+        with Instrument.timer(instrument, 'parse'):
+            in_fid = open(fid, "r")
+            if compact:
+                self.in_file = None
+                self.scene = Scene(in_fid)
+            else:
+                self.in_file = in_fid.readlines()
+                self.scene = {}
+                self.read_scene()
+            in_fid.close()
 
     def read_scene(self):
         for line in self.in_file:
-            line = line.strip()
+            add_line(self.scene, line)
+
+
+def parse_line(line):
+    """
+    Splits a scene file line into (obj_id, feature, value); value is
+    {cell: val} for 9-cell grid features.
+    """
+    split_line = line.split()
+    obj_id = split_line[0]
+    feature = split_line[1]
+    if len(split_line[2:]) == 9:
+        value = {}
+        for cell in split_line[2:]:
+            split_cell = cell.split(":")
+            value[int(split_cell[0])] = split_cell[1]
+    else:
+        value = split_line[2]
+    return (obj_id, feature, value)
+
+
+def add_line(scene, line):
+    (obj_id, feature, value) = parse_line(line)
+    try:
+        scene[obj_id][feature] = value
+    except KeyError:
+        scene[obj_id] = {feature:value}
+
+
+def read_lines(fid, buffer_size=BUFFER_SIZE):
+    """
+    Yields the lines of a file (path or open file) reading at most
+    buffer_size bytes at a time; only a line longer than the buffer
+    makes it grow.
+    """
+    if isinstance(fid, basestring):
+        in_fid = open(fid, "r")
+    else:
+        in_fid = fid
+    try:
+        rest = ""
+        while True:
+            chunk = in_fid.read(buffer_size)
+            if chunk == "":
+                break
+            lines = (rest + chunk).split("\n")
+            rest = lines.pop()
+            for line in lines:
+                yield line
+        if rest != "":
+            yield rest
+    finally:
+        if in_fid is not fid:
+            in_fid.close()
+
+
+def read_scenes(fid, buffer_size=BUFFER_SIZE, compact=False):
+    """
+    Lazily yields one scene at a time from a file of concatenated scenes,
+    separated by blank lines.  Scenes are dicts as in Read, or columnar
+    Scenes with compact=True.
+    """
+    lines = read_lines(fid, buffer_size)
+    for line in lines:
+        if line.strip() == "":
+            continue
+        block = itertools.chain([line], itertools.takewhile(lambda next_line: next_line.strip() != "", lines))
+        if compact:
+            yield Scene(block)
+        else:
+            scene = {}
+            for line in block:
+                add_line(scene, line)
+            yield scene
+
+
+def read_objects(fid, buffer_size=BUFFER_SIZE):
+    """
+    Lazily yields (obj_id, {feature: value}) for each run of consecutive
+    lines about the same object.  A blank line ends a run, as it ends a
+    scene in read_scenes, so the last object of one scene and the first
+    of the next are kept apart even if they share an id.
+    """
+    lines = read_lines(fid, buffer_size)
+    for (obj_id, obj_lines) in itertools.groupby(lines, object_key):
+        if obj_id is None:
+            continue
+        obj = {}
+        for line in obj_lines:
+            (obj_id, feature, value) = parse_line(line)
+            obj[feature] = value
+        yield (obj_id, obj)
+
+
+def object_key(line):
+    # The object id a line is about, or None for a blank line.
+    split_line = line.split()
+    if split_line == []:
+        return None
+    return split_line[0]
+
+
+class Scene():
+    """
+    Columnar scene store.  Object ids are kept once, in row order; each
+    feature is one column over the rows:
+        numeric features:   float array, NaN where the object lacks it
+        other features:     int array of codes into self.strings, -1 where missing
+        9-cell grid features:   (n_objects x 9) array of either kind
+    A feature is numeric only if every value reads back as written (see
+    number_string), so scene[obj_id][feature] gives the same string, or
+    {cell: string} for grid features, as the dict scene does.
+    """
+    def __init__(self, lines=()):
+        self.ids = []
+        self.rows = {}
+        self.values = {}
+        self.grids = {}
+        self.strings = []
+        self.string_codes = {}
+        self.read(lines)
+
+    def read(self, lines):
+        # Parses into per-feature lists first; the arrays are built once at the end.
+        pending = {}
+        pending_grids = {}
+        for line in lines:
             split_line = line.split()
-            obj_id = split_line[0]
-            feature = split_line[1]
+            if split_line == []:
+                continue
+            obj_id = intern(split_line[0])
+            feature = intern(split_line[1])
             try:
-                self.scene[obj_id][feature] = {}
+                row = self.rows[obj_id]
             except KeyError:
-                self.scene[obj_id] = {feature:{}}
+                row = len(self.ids)
+                self.rows[obj_id] = row
+                self.ids += [obj_id]
             if len(split_line[2:]) == 9:
+                cells = [None] * 9
                 for cell in split_line[2:]:
                     split_cell = cell.split(":")
-                    self.scene[obj_id][feature][int(split_cell[0])] = split_cell[1]
+                    cells[int(split_cell[0])] = split_cell[1]
+                pending_grids.setdefault(feature, ([], []))
+                pending_grids[feature][0].append(row)
+                pending_grids[feature][1].append(cells)
             else:
-                self.scene[obj_id][feature] = split_line[2]
+                pending.setdefault(feature, ([], []))
+                pending[feature][0].append(row)
+                pending[feature][1].append(split_line[2])
+        n = len(self.ids)
+        # Values repeat (grid cells especially), so each is checked once.
+        numbers = {}
+        def number(val):
+            try:
+                return numbers[val]
+            except KeyError:
+                numbers[val] = number_value(val)
+                return numbers[val]
+        for feature in pending:
+            (rows, vals) = pending[feature]
+            try:
+                column = self.extend(self.values.get(feature), n, numpy.nan, float)
+                column[rows] = [number(val) for val in vals]
+            except ValueError:
+                column = self.extend(self.values.get(feature), n, -1, numpy.int32)
+                column[rows] = [self.intern_string(val) for val in vals]
+            self.values[feature] = column
+        for feature in pending_grids:
+            (rows, cells) = pending_grids[feature]
+            try:
+                column = self.extend(self.grids.get(feature), n, numpy.nan, float, 9)
+                column[rows] = [[numpy.nan if val is None else number(val) for val in row] for row in cells]
+            except ValueError:
+                column = self.extend(self.grids.get(feature), n, -1, numpy.int32, 9)
+                column[rows] = [[-1 if val is None else self.intern_string(val) for val in row] for row in cells]
+            self.grids[feature] = column
+
+    def extend(self, column, n, missing, dtype, width=None):
+        # Grows a column to n rows, filling the new rows with the missing value.
+        if width is None:
+            new_column = numpy.empty(n, dtype=dtype)
+        else:
+            new_column = numpy.empty((n, width), dtype=dtype)
+        new_column.fill(missing)
+        if column is not None:
+            if column.dtype != new_column.dtype:
+                # A string column that gets numbers stays a string column.
+                raise ValueError("column type changed")
+            new_column[:len(column)] = column
+        return new_column
+
+    def intern_string(self, val):
+        try:
+            return self.string_codes[val]
+        except KeyError:
+            self.string_codes[val] = len(self.strings)
+            self.strings += [val]
+            return self.string_codes[val]
+
+    def is_numeric(self, feature):
+        return self.values[feature].dtype.kind == 'f'
+
+    def string(self, val):
+        # A stored value as written in the file, or None where missing (NaN or -1).
+        if isinstance(val, float):
+            if val != val:
+                return None
+            return number_string(val)
+        if val < 0:
+            return None
+        return self.strings[val]
+
+    def get(self, obj_id, feature):
+        row = self.rows[obj_id]
+        if feature in self.grids:
+            cells = [self.string(val) for val in self.grids[feature][row].tolist()]
+            cells = dict((idx, cells[idx]) for idx in range(9) if cells[idx] is not None)
+            if cells != {}:
+                return cells
+        if feature in self.values:
+            val = self.string(self.values[feature][row].item())
+            if val is not None:
+                return val
+        raise KeyError(feature)
+
+    def items(self, obj_id):
+        """
+        [(feature, value) ...] for one object, in one pass over the columns.
+        """
+        row = self.rows[obj_id]
+        items = []
+        grid_features = set()
+        for feature in self.grids:
+            cells = [self.string(val) for val in self.grids[feature][row].tolist()]
+            cells = dict((idx, cells[idx]) for idx in range(9) if cells[idx] is not None)
+            if cells != {}:
+                items += [(feature, cells)]
+                grid_features.add(feature)
+        for feature in self.values:
+            if feature in grid_features:
+                continue
+            val = self.string(self.values[feature][row].item())
+            if val is not None:
+                items += [(feature, val)]
+        return items
+
+    def features(self, obj_id):
+        return [feature for feature in list(self.grids) + list(self.values) if self.has(obj_id, feature)]
+
+    def has(self, obj_id, feature):
+        try:
+            self.get(obj_id, feature)
+            return True
+        except KeyError:
+            return False
+
+    def __getitem__(self, obj_id):
+        if obj_id not in self.rows:
+            raise KeyError(obj_id)
+        return SceneObject(self, obj_id)
+
+    def __contains__(self, obj_id):
+        return obj_id in self.rows
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def keys(self):
+        return list(self.ids)
+
+    def nbytes(self):
+        """
+        Approximate memory held by the store, for comparison with the dict scene.
+        """
+        size = sys.getsizeof(self.ids) + sys.getsizeof(self.rows) + sys.getsizeof(self.strings) + sys.getsizeof(self.string_codes)
+        size += sum([sys.getsizeof(obj_id) for obj_id in self.ids])
+        size += sum([sys.getsizeof(val) for val in self.strings])
+        for columns in (self.values, self.grids):
+            size += sys.getsizeof(columns)
+            size += sum([columns[feature].nbytes for feature in columns])
+        return size
+
+
+def number_string(val):
+    # The canonical way a number is written in scene files: "10", "0.25".
+    if val == int(val):
+        return "%d" % val
+    return repr(val)
+
+
+def number_value(string):
+    """
+    The float a scene value string stands for, or ValueError if it does not
+    read back as written (e.g. "1e3", "0.50", "nan"), so that the Scene can
+    keep it as a string instead.
+    """
+    val = float(string)
+    try:
+        if number_string(val) == string:
+            return val
+    except (ValueError, OverflowError):
+        pass
+    raise ValueError("not a canonical number: " + string)
+
+
+class SceneObject():
+    """
+    Read-only dict-style view of one object in a Scene.
+    """
+    def __init__(self, scene, obj_id):
+        self.scene = scene
+        self.obj_id = obj_id
+
+    def __getitem__(self, feature):
+        return self.scene.get(self.obj_id, feature)
+
+    def __contains__(self, feature):
+        return self.scene.has(self.obj_id, feature)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        return self.scene.features(self.obj_id)
+
+    def items(self):
+        return self.scene.items(self.obj_id)
+
+    def get(self, feature, default=None):
+        try:
+            return self[feature]
+        except KeyError:
+            return default
+
+
+class GridIndex():
+    """
+    Spatial index over the 9-cell grid features: cell idx is row idx // 3,
+    column idx % 3 of a 3 x 3 grid over the scene.  Keeps, for each cell,
+    the objects occupying it (value > 0), and buckets objects by their
+    occupancy-weighted centroid in a finer grid (CENTROID_RESOLUTION
+    buckets per side over the 0..2 x 0..2 centroid range), so that
+    nearest-neighbour queries visit rings of buckets outward from the
+    object's own and stop once no farther ring can hold a nearer object.
+    """
+    def __init__(self, scene=None, feature=None):
+        """
+        scene is a dict scene or a Scene; feature names its 9-cell feature
+        (by default the only grid feature the objects have).
+        """
+        self.feature = feature
+        # [set of obj_ids occupying cell idx]
+        self.cells = [set() for idx in range(9)]
+        # {(row, col) : set of obj_ids whose centroid falls in that bucket}
+        self.buckets = {}
+        self.occupancy = {}
+        self.centroids = {}
+        if scene is not None:
+            for obj_id in scene:
+                cells = self.grid_feature(scene[obj_id])
+                if cells is not None:
+                    self.insert(obj_id, cells)
+
+    def grid_feature(self, obj):
+        if self.feature is not None:
+            return obj.get(self.feature)
+        grids = [(feature, value) for (feature, value) in obj.items() if isinstance(value, dict)]
+        if grids == []:
+            return None
+        if len(grids) > 1:
+            raise ValueError("objects have several grid features; give the feature to index")
+        return grids[0][1]
+
+    def insert(self, obj_id, cells):
+        """
+        Adds (or moves) an object with {cell: value} occupancy.
+        """
+        if obj_id in self.occupancy:
+            self.remove(obj_id)
+        cells = dict((int(idx), float(cells[idx])) for idx in cells if float(cells[idx]) > 0)
+        if cells == {}:
+            return None
+        total = sum(cells.values())
+        centroid = (sum([(idx // 3) * val for (idx, val) in cells.items()]) / total, \
+                    sum([(idx % 3) * val for (idx, val) in cells.items()]) / total)
+        self.occupancy[obj_id] = cells
+        self.centroids[obj_id] = centroid
+        for idx in cells:
+            self.cells[idx].add(obj_id)
+        self.buckets.setdefault(centroid_bucket(centroid), set()).add(obj_id)
+
+    def remove(self, obj_id):
+        cells = self.occupancy.pop(obj_id)
+        centroid = self.centroids.pop(obj_id)
+        for idx in cells:
+            self.cells[idx].discard(obj_id)
+        bucket = centroid_bucket(centroid)
+        self.buckets[bucket].discard(obj_id)
+        if not self.buckets[bucket]:
+            del self.buckets[bucket]
+        return cells
+
+    def objects_in(self, cells):
+        """
+        The objects occupying any of the given cells.
+        """
+        if isinstance(cells, int):
+            cells = [cells]
+        found = set()
+        for idx in cells:
+            found |= self.cells[idx]
+        return found
+
+    def nearest(self, obj_id, k):
+        """
+        The k objects whose centroids are nearest to obj_id's, as
+        [(obj_id, distance) ...] from nearest (ties by obj_id).
+        """
+        (y, x) = self.centroids[obj_id]
+        (row, col) = centroid_bucket((y, x))
+        width = 2.0 / CENTROID_RESOLUTION
+        best = []
+        for ring in range(CENTROID_RESOLUTION):
+            # Buckets in this ring are at least ring - 1 whole buckets away.
+            if len(best) >= k and (ring - 1) * width > best[-1][0]:
+                break
+            found = []
+            for bucket in ring_buckets(row, col, ring):
+                for other in self.buckets.get(bucket, ()):
+                    if other == obj_id:
+                        continue
+                    (oy, ox) = self.centroids[other]
+                    found += [(((oy - y) ** 2 + (ox - x) ** 2) ** 0.5, other)]
+            if found:
+                best = heapq.nsmallest(k, best + found)
+        return [(other, distance) for (distance, other) in best]
+
+    def __len__(self):
+        return len(self.occupancy)
+
+
+def centroid_bucket(centroid):
+    (y, x) = centroid
+    scale = CENTROID_RESOLUTION / 2.0
+    return (min(int(y * scale), CENTROID_RESOLUTION - 1), min(int(x * scale), CENTROID_RESOLUTION - 1))
+
+
+def ring_buckets(row, col, ring):
+    # The buckets ring buckets away from (row, col), in each direction, inside the grid.
+    if ring == 0:
+        return [(row, col)]
+    rows = range(max(row - ring, 0), min(row + ring, CENTROID_RESOLUTION - 1) + 1)
+    cols = range(max(col - ring, 0), min(col + ring, CENTROID_RESOLUTION - 1) + 1)
+    return [(r, c) for r in rows for c in cols if max(abs(r - row), abs(c - col)) == ring]
+
+
+def deep_sizeof(obj):
+    """
+    Memory held by nested dicts/lists of strings, as in the dict scene.
+    """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key in obj:
+            size += deep_sizeof(key) + deep_sizeof(obj[key])
+    elif isinstance(obj, (list, tuple)):
+        for val in obj:
+            size += deep_sizeof(val)
+    return size
+
+
+def memory_benchmark(fid):
+    """
+    Side-by-side memory of the dict scene and the columnar Scene for a file.
+    """
+    dict_bytes = deep_sizeof(Read(fid).scene)
+    scene = Read(fid, compact=True).scene
+    compact_bytes = scene.nbytes()
+    print "objects:", len(scene)
+    print "dict scene bytes:", dict_bytes
+    print "columnar scene bytes:", compact_bytes
+    print "ratio:", dict_bytes / float(max(compact_bytes, 1))
+    return (dict_bytes, compact_bytes)
+
+
+if __name__ == "__main__":
+    memory_benchmark(sys.argv[1])
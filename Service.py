@@ -0,0 +1,330 @@
+import os
+import sys
+import json
+import time
+import signal
+import Queue
+import argparse
+import threading
+import collections
+import SocketServer
+import numpy
+
+import KB
+import SizeAlgorithm
+
+###
+### Long-lived prediction service: keeps the KB and a SizeAlgorithm loaded
+### and answers JSON-lines requests over stdin/stdout or a local (Unix)
+### socket.  Requests that arrive within a short window of each other are
+### answered as one batch, by a single thread that owns the algorithm.
+###
+### python Service.py                        (stdin/stdout)
+### python Service.py --socket /tmp/size.sock
+###
+### Requests, each with an optional "id" that is echoed in its response
+### (responses come back as their batches finish, so match them by id):
+### {"op": "size", "referent": [w, h], "distractor": [w, h]}
+###     -> {"mod": ["ind", "y"], "pol": 1, "lemma": "tall"}
+###     "distractors": [[w, h] ...] in place of "distractor" uses size_mod_set.
+### {"op": "typicality", "object": {att: val}}
+###     -> {"scores": {att: prob}, "atypical": att, "implied": [att ...]}
+### {"op": "stats"}
+###     -> {"requests", "batches", "p50_ms", "p99_ms"}
+###
+
+# Latencies kept for the percentiles: the most recent this many requests.
+LATENCY_SAMPLES = 100000
+# Seconds between checks while waiting, so that signals still get handled.
+POLL_INTERVAL = 0.5
+# Types an object's attribute values may have.
+SCALAR_TYPES = (basestring, int, long, float, bool, type(None))
+
+
+class Service():
+    def __init__(self, prototypes=None, size_alg=None, window=0.002, max_batch=1024):
+        """
+        prototypes is a KB.Prototypes (default KB.shared_prototypes()) and
+        size_alg a SizeAlgorithm.SizeAlgorithm (default a fresh one).
+        A batch is closed window seconds after its first request arrives,
+        or once it holds max_batch requests.
+        """
+        if prototypes is None:
+            prototypes = KB.shared_prototypes()
+        if size_alg is None:
+            size_alg = SizeAlgorithm.SizeAlgorithm()
+        self.prototypes = prototypes
+        self.matrix = prototypes.compile_matrix()
+        self.implications = prototypes.compile_implications()
+        self.size_alg = size_alg
+        self.window = window
+        self.max_batch = max_batch
+        # (arrival time, request, callback) ... ; None stops the batching thread.
+        self.requests = Queue.Queue()
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.num_requests = 0
+        self.num_batches = 0
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.requests.put(None)
+        self.thread.join()
+
+    def submit(self, request, callback):
+        """
+        Queues request; callback(response) is called from the batching thread.
+        """
+        self.requests.put((time.time(), request, callback))
+
+    def call(self, request):
+        # submit, waiting for the response.
+        done = threading.Event()
+        responses = []
+        def callback(response):
+            responses.append(response)
+            done.set()
+        self.submit(request, callback)
+        while not done.wait(POLL_INTERVAL):
+            pass
+        return responses[0]
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            item = self.requests.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.time() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.requests.get(timeout=timeout)
+                except Queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch += [item]
+            self.process(batch)
+
+    def process(self, batch):
+        # Nothing a batch does may stop the thread: every request still gets a response.
+        try:
+            responses = self.answer([request for (arrival, request, callback) in batch])
+        except Exception, e:
+            responses = [{'error': "internal error: %r" % (e,)} for item in batch]
+        now = time.time()
+        with self.lock:
+            self.num_batches += 1
+            self.num_requests += len(batch)
+            for (arrival, request, callback) in batch:
+                self.latencies.append(now - arrival)
+        for ((arrival, request, callback), response) in zip(batch, responses):
+            try:
+                callback(response)
+            except Exception, e:
+                # E.g. a client that went away; the others still get theirs.
+                sys.stderr.write("Could not deliver response: %r\n" % (e,))
+
+    def answer(self, requests):
+        """
+        Responses to a batch of requests: all size requests against a single
+        distractor go through one size_mod_batch, and all typicality
+        requests through one PrototypeMatrix.typicality.
+        """
+        responses = [None] * len(requests)
+        pairs = []
+        objects = []
+        for (n, request) in enumerate(requests):
+            try:
+                op = request.get('op', 'size')
+                if op == 'size':
+                    (rx, ry) = [float(v) for v in request['referent']]
+                    if 'distractors' in request:
+                        distractors = numpy.array(request['distractors'], dtype=float).reshape(-1, 2)
+                        responses[n] = size_response(*self.size_alg.size_mod_set(rx, ry, distractors[:, 0], distractors[:, 1]))
+                    else:
+                        (dx, dy) = [float(v) for v in request['distractor']]
+                        pairs += [(n, (rx, ry, dx, dy))]
+                elif op == 'typicality':
+                    objects += [(n, scene_object(request['object']))]
+                elif op == 'stats':
+                    responses[n] = self.stats()
+                else:
+                    responses[n] = {'error': "unknown op: %s" % op}
+            except (AttributeError, KeyError, TypeError, ValueError), e:
+                responses[n] = {'error': "bad request: %r" % (e,)}
+        # A failing batched call fails only the requests in it.
+        if pairs:
+            try:
+                dims = numpy.array([pair_dims for (n, pair_dims) in pairs], dtype=float)
+                (mods, pols) = self.size_alg.size_mod_batch(dims[:, 0], dims[:, 1], dims[:, 2], dims[:, 3])
+                for ((n, pair_dims), (mod, pol)) in zip(pairs, self.size_alg.decode_batch(mods, pols)):
+                    responses[n] = size_response(mod, pol)
+            except Exception, e:
+                for (n, pair_dims) in pairs:
+                    responses[n] = {'error': "internal error: %r" % (e,)}
+        if objects:
+            try:
+                self.answer_objects(objects, responses)
+            except Exception:
+                # Answers them one by one, so that only the object at fault fails.
+                for (n, object) in objects:
+                    try:
+                        self.answer_objects([(n, object)], responses)
+                    except Exception, e:
+                        responses[n] = {'error': "internal error: %r" % (e,)}
+        for (request, response) in zip(requests, responses):
+            if isinstance(request, dict) and 'id' in request:
+                response['id'] = request['id']
+        return responses
+
+    def answer_objects(self, objects, responses):
+        # Fills in the responses to [(request number, object) ...] in one batch.
+        (scores, atypical) = self.matrix.typicality([object for (n, object) in objects])
+        implied = self.implications.implied_batch([object for (n, object) in objects])
+        for (k, (n, object)) in enumerate(objects):
+            responses[n] = {'scores': scores[k], 'atypical': atypical[k], 'implied': sorted(implied[k])}
+
+    def stats(self):
+        """
+        {'requests', 'batches', 'p50_ms', 'p99_ms'}: request latency, from
+        arrival to the end of its batch, over the most recent requests.
+        """
+        with self.lock:
+            latencies = numpy.array(self.latencies) * 1000
+            stats = {'requests': self.num_requests, 'batches': self.num_batches, 'p50_ms': None, 'p99_ms': None}
+        if len(latencies):
+            (stats['p50_ms'], stats['p99_ms']) = numpy.percentile(latencies, [50, 99]).tolist()
+        return stats
+
+
+def scene_object(value):
+    """
+    A typicality request's object as {att: val}; values must be scalars.
+    """
+    if not isinstance(value, dict):
+        raise TypeError("object must be {att: value}")
+    for (att, val) in value.items():
+        if not isinstance(val, SCALAR_TYPES):
+            raise TypeError("attribute %r must have a string or number value" % (att,))
+    return dict(value)
+
+
+def size_response(mod, pol):
+    return {'mod': mod, 'pol': pol, 'lemma': KB.Size((mod, pol)).lemma}
+
+
+class LineWriter():
+    """
+    Writes responses as JSON lines, from whichever thread answers them,
+    and lets the reader wait at end of input for those still outstanding.
+    """
+    def __init__(self, fout):
+        self.fout = fout
+        self.outstanding = 0
+        self.done = threading.Condition()
+
+    def expect(self):
+        with self.done:
+            self.outstanding += 1
+
+    def write(self, response):
+        with self.done:
+            self.fout.write(json.dumps(response) + "\n")
+            self.fout.flush()
+            self.outstanding -= 1
+            self.done.notify_all()
+
+    def wait(self):
+        with self.done:
+            while self.outstanding > 0:
+                self.done.wait(POLL_INTERVAL)
+
+
+def serve_lines(service, fin, fout):
+    """
+    Answers JSON-lines requests from fin on fout until end of input.
+    """
+    writer = LineWriter(fout)
+    # readline rather than iterating over fin, whose read-ahead would hold
+    # requests back until its buffer fills.
+    for line in iter(fin.readline, ""):
+        line = line.strip()
+        if not line:
+            continue
+        writer.expect()
+        try:
+            request = json.loads(line)
+        except ValueError:
+            writer.write({'error': "bad JSON"})
+            continue
+        service.submit(request, writer.write)
+    writer.wait()
+
+
+class LineHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        serve_lines(self.server.service, self.rfile, self.wfile)
+
+
+def serve_socket(service, path):
+    """
+    Serves JSON lines on the Unix socket at path, one thread per connection,
+    all feeding the service's batches.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    server = SocketServer.ThreadingUnixStreamServer(path, LineHandler)
+    server.daemon_threads = True
+    server.service = service
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
+def interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Serves size and typicality predictions as JSON lines.")
+    parser.add_argument("--socket", default=None, help="Unix socket path (default stdin/stdout)")
+    parser.add_argument("--kb", default=None, help="prototype file (default KB.KB_PATH)")
+    parser.add_argument("--window", type=float, default=2.0, help="batching window in ms")
+    parser.add_argument("--max-batch", type=int, default=1024)
+    parser.add_argument("--seed", default=None)
+    parser.add_argument("--cache-size", type=int, default=None, help="size decision cache (see SizeAlgorithm)")
+    args = parser.parse_args(argv)
+    size_alg = SizeAlgorithm.SizeAlgorithm(seed=args.seed, cache_size=args.cache_size)
+    service = Service(KB.shared_prototypes(args.kb), size_alg, args.window / 1000.0, args.max_batch).start()
+    # Shuts down (and removes the socket) on SIGTERM as on ^C.
+    signal.signal(signal.SIGTERM, interrupt)
+    try:
+        if args.socket:
+            serve_socket(service, args.socket)
+        else:
+            serve_lines(service, sys.stdin, sys.stdout)
+    except KeyboardInterrupt:
+        pass
+    stats = service.stats()
+    if stats['requests']:
+        sys.stderr.write("%d requests in %d batches; latency p50 %.2f ms, p99 %.2f ms\n" % \
+                         (stats['requests'], stats['batches'], stats['p50_ms'], stats['p99_ms']))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,109 @@
+import math
+import numpy
+
+###
+### Paired significance tests over per-referent scores, e.g. the
+### sig_precision/sig_recall values kept by SizeAlgorithm.Evaluator.
+### Scores may be one vector per system, or one row per metric (all
+### rows then share the same resamples), giving one result per row.
+###
+
+# Resamples are drawn in blocks of about this many (resample, referent) cells,
+# to bound memory.
+BLOCK_CELLS = 1 << 22
+
+# The bootstrap draws how often each referent is resampled.  With at least
+# POISSON_MIN referents these counts are Poisson(1) (the Poisson bootstrap),
+# read off a 16-bit inverse-CDF table, which is far cheaper than drawing
+# them from the multinomial and matches it closely at that size.
+POISSON_MIN = 64
+POISSON_CDF = numpy.cumsum([math.exp(-1) / math.factorial(k) for k in range(20)])
+POISSON_TABLE = numpy.searchsorted(POISSON_CDF, (numpy.arange(1 << 16) + 0.5) / (1 << 16)).astype(float)
+
+
+def resample_blocks(resamples, n):
+    block = max(1, min(resamples, BLOCK_CELLS // max(n, 1)))
+    for start in range(0, resamples, block):
+        yield (start, min(block, resamples - start))
+
+
+def resample_counts(rng, block, n):
+    # (block, n) times each referent is drawn in each resample.
+    if n < POISSON_MIN:
+        return rng.multinomial(n, numpy.ones(n) / n, size=block).astype(float)
+    draws = numpy.frombuffer(rng.bytes(2 * block * n), dtype=numpy.uint16).reshape(block, n)
+    return POISSON_TABLE.take(draws)
+
+
+def paired_diffs(scores_a, scores_b):
+    scores_a = numpy.asarray(scores_a, dtype=float)
+    diffs = numpy.atleast_2d(scores_a - numpy.asarray(scores_b, dtype=float))
+    return (diffs, scores_a.ndim == 1)
+
+
+def paired_bootstrap(scores_a, scores_b, resamples=10000, alpha=0.05, seed=None):
+    """
+    Paired bootstrap over referents for the difference in mean score (a - b).
+    Returns {'diff', 'ci': (low, high), 'p'}: the (1 - alpha) percentile
+    confidence interval of the difference, and the two-sided p-value of
+    the difference being 0.
+    """
+    (diffs, single) = paired_diffs(scores_a, scores_b)
+    n = diffs.shape[1]
+    rng = numpy.random.RandomState(seed)
+    boot = numpy.empty((len(diffs), resamples))
+    for (start, block) in resample_blocks(resamples, n):
+        # All rows share the same draws: one product gives every resample's mean.
+        counts = resample_counts(rng, block, n)
+        boot[:, start:start + block] = diffs.dot(counts.T) / numpy.maximum(counts.sum(axis=1), 1)
+    results = []
+    for (row_diffs, row_boot) in zip(diffs, boot):
+        observed = row_diffs.mean()
+        # Bootstrap differences are centred on the observed one; how often does
+        # one stray as far from it as the observed difference is from 0?
+        p = numpy.mean(numpy.abs(row_boot - observed) >= abs(observed))
+        (low, high) = numpy.percentile(row_boot, [100 * alpha / 2, 100 * (1 - alpha / 2)])
+        results += [{'diff': observed, 'ci': (low, high), 'p': p}]
+    if single:
+        return results[0]
+    return results
+
+
+def approximate_randomization(scores_a, scores_b, resamples=10000, seed=None):
+    """
+    Approximate randomization test for the difference in mean score (a - b):
+    each resample swaps the two systems' scores on a random half of the
+    referents.  Returns {'diff', 'p'} with the two-sided p-value.
+    """
+    (diffs, single) = paired_diffs(scores_a, scores_b)
+    n = diffs.shape[1]
+    observed = diffs.mean(axis=1)
+    rng = numpy.random.RandomState(seed)
+    extreme = numpy.zeros(len(diffs), dtype=int)
+    for (start, block) in resample_blocks(resamples, n):
+        # One random bit per (resample, referent) decides the swap.
+        bits = numpy.unpackbits(numpy.frombuffer(rng.bytes((block * n + 7) // 8), dtype=numpy.uint8))
+        signs = bits[:block * n].reshape(block, n) * 2.0 - 1
+        shuffled = signs.dot(diffs.T) / n
+        extreme += numpy.count_nonzero(numpy.abs(shuffled) >= numpy.abs(observed) - 1e-12, axis=0)
+    p = (extreme + 1) / float(resamples + 1)
+    results = [{'diff': row_observed, 'p': row_p} for (row_observed, row_p) in zip(observed, p)]
+    if single:
+        return results[0]
+    return results
+
+
+def compare(scores_a, scores_b, resamples=10000, alpha=0.05, seed=None):
+    """
+    Both tests on a pair of per-referent scores:
+    {'mean_a', 'mean_b', 'bootstrap', 'randomization'} (a list of these
+    when the scores have one row per metric).
+    """
+    mean_a = numpy.mean(scores_a, axis=-1)
+    mean_b = numpy.mean(scores_b, axis=-1)
+    bootstrap = paired_bootstrap(scores_a, scores_b, resamples, alpha, seed)
+    randomization = approximate_randomization(scores_a, scores_b, resamples, seed)
+    if numpy.ndim(scores_a) == 1:
+        return {'mean_a': mean_a, 'mean_b': mean_b, 'bootstrap': bootstrap, 'randomization': randomization}
+    return [{'mean_a': row[0], 'mean_b': row[1], 'bootstrap': row[2], 'randomization': row[3]} \
+            for row in zip(mean_a, mean_b, bootstrap, randomization)]
@@ -1,5 +1,13 @@
 import sys
+import math
+import zlib
 import random
+import collections
+import multiprocessing
+import numpy
+import Significance
+import Instrument
+import Corpus
 
 ###
 ### Implementation of the Size Algorithm detailed in:
@@ -8,8 +16,74 @@ import random
 ###
 ###
 
+# Integer encoding of the modifier types, used by the batch (array) path.
+# Index into MOD_TYPES to decode; polarity NO_POL marks "no prediction".
+MOD_TYPES = (None, 'over', ('ind', 'x'), ('ind', 'y'))
+MOD_CODES = dict((mod_type, code) for (code, mod_type) in enumerate(MOD_TYPES))
+NO_POL = -1
+
+# Written (or counted as 'H3 tie') for each H3 case whose differences tie.
+TIE_WARNING = "Warning:  Guessing 'y', should randomize?\n"
+
+
+def mod_type_hash(expression):
+    """
+    Returns {mod : number of times mod occurs in expression}.
+    """
+    type_hash = {}
+    for mod in expression:
+        try:
+            type_hash[mod] += 1
+        except KeyError:
+            type_hash[mod] = 1
+    return type_hash
+
+
+class DecisionCache():
+    """
+    Bounded {key : value} store with least-recently-used eviction, for
+    SizeAlgorithm's size decisions.  Counts hits, misses and evictions.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, uses=1):
+        # The value for key, now most recently used, or None.  A batch with
+        # uses rows of the same key counts them as a loop over them would:
+        # a miss is followed by uses - 1 hits on the value then put.
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            self.hits += uses - 1
+            return None
+        self.entries[key] = value
+        self.hits += uses
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return value
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return {'size': len(self.entries), 'max_size': self.max_size, \
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
 class SizeAlgorithm():
-    def __init__(self, size_hash=None, observed_hash=None):
+    def __init__(self, size_hash=None, observed_hash=None, seed=None, expectation=False, instrument=None, \
+                 cache_size=None, quantum=None):
         """
         Assumes size_hash is of the format:
         {supertype : {subtype : {'referent': (height, width), 'distractor': (height, width)}}}
@@ -21,150 +95,609 @@ class SizeAlgorithm():
         E.g.,
         {supertype: {subtype : {1: [('over', 0)]}}}
         {supertype: {subtype : {3: [(('ind', 'x'), 1)]}}}
+        or a Corpus.Corpus compiled from one, which predict, evaluate,
+        oracle_predict and maj_predict read directly (add_expression and
+        remove_expression need the dicts).
+        seed gives the instance its own random.Random for calc_ratio;
+        without it the global random module is used.
+        With expectation=True, predict does not sample H1 cases but keeps
+        both outcomes with their probabilities in expected_hash, and
+        evaluate returns the expected precision/recall.
+        instrument is an Instrument.Stats to collect decision branch counts,
+        warnings and stage timings in (see run_stats), or None.
+        cache_size bounds an LRU cache of size decisions (see decide),
+        keyed on the dimensions rounded to the nearest multiple of quantum
+        if given (decisions are then made on the rounded dimensions; a
+        positive dimension rounds to at least quantum, never to 0).
+        H1 cases cache ratio_val, not the sampled outcome.  None: no cache.
         """
+        if seed is None:
+            self.random = random
+        else:
+            self.random = random.Random(seed)
+        self.expectation = expectation
+        self.instrument = instrument
+        self.cache = None
+        if cache_size:
+            self.cache = DecisionCache(cache_size)
+        self.quantum = quantum
+        self.expected_hash = {}
         self.size_hash = size_hash
         self.observed_hash = observed_hash
         self.accuracy = None
         self.prediction_hash = {}
+        self.or_prediction_hash = {}
+        self.maj_prediction_hash = {}
+        # Per-referent and whole-domain modifier type counts; see count_types.
+        self.type_counts = None
+        self.global_counts = None
+        # {referent's own counts, as a frozenset of items : set of (supertype, subtype)}
+        # and {those counts : majority prediction}; see update_majority.
+        self.signatures = None
+        self.signature_majority = None
         return None
 
 
+    @Instrument.timed('predict')
     def predict(self):
         """
         Makes predictions based on the given referent/distractor heights/widths 
+        A subtype may give 'distractors': [(width, height) ...] instead of
+        one 'distractor'; see size_mod_set.
         """
+        referents = []
+        dims = []
+        self.expected_hash = {}
         for supertype in self.observed_hash:
             self.prediction_hash[supertype] = {}
             for subtype in self.observed_hash[supertype]:
                 self.prediction_hash[supertype][subtype] = {}
                 # Checks to make sure format is correct.
                 try:
-                    #print supertype, subtype
-                    #print self.size_hash[supertype][subtype]
                     # (rx, ry) = (referent width, referent height)
                     (rx, ry) = self.size_hash[supertype][subtype]['referent']
+                    if 'distractors' in self.size_hash[supertype][subtype]:
+                        distractors = numpy.array(self.size_hash[supertype][subtype]['distractors'], dtype=float).reshape(-1, 2)
+                        (mod, pol) = self.size_mod_set(rx, ry, distractors[:, 0], distractors[:, 1])
+                        self.prediction_hash[supertype][subtype] = [(mod, pol)]
+                        self.expected_hash.setdefault(supertype, {})[subtype] = [([(mod, pol)], 100)]
+                        continue
                     # (dx, dy) = (distractor width, distractor height)
                     (dx, dy) = self.size_hash[supertype][subtype]['distractor']
                 except KeyError:
                     sys.stderr.write("Size hash formatted incorrectly; exiting...\n")
                     sys.exit()
-                # Calls to size_mod to make a prediction based on the given heights/widths.
-                (mod, pol) = self.size_mod(rx, ry, dx, dy)
+                referents += [(supertype, subtype)]
+                dims += [(rx, ry, dx, dy)]
+        if dims == []:
+            return self.prediction_hash
+        # Makes all predictions in one pass based on the given heights/widths.
+        dims = numpy.array(dims, dtype=float)
+        if not self.expectation:
+            (mods, pols) = self.size_mod_batch(dims[:, 0], dims[:, 1], dims[:, 2], dims[:, 3])
+            predictions = self.decode_batch(mods, pols)
+            for ((supertype, subtype), (mod, pol)) in zip(referents, predictions):
                 self.prediction_hash[supertype][subtype] = [(mod, pol)]
+            return self.prediction_hash
+        (mods, pols, vals) = self.size_mod_batch(dims[:, 0], dims[:, 1], dims[:, 2], dims[:, 3], expectation=True)
+        predictions = self.decode_batch(mods, pols)
+        for ((supertype, subtype), (mod, pol), val) in zip(referents, predictions, vals.tolist()):
+            # [(prediction, probability in percent) ...]
+            alternatives = [([(mod, pol)], val), ([('over', pol)], 100 - val)]
+            alternatives = [(prediction, val) for (prediction, val) in alternatives if val > 0]
+            self.expected_hash.setdefault(supertype, {})[subtype] = alternatives
+            # prediction_hash keeps the most probable outcome.
+            self.prediction_hash[supertype][subtype] = max(alternatives, key=lambda alternative: alternative[1])[0]
         return self.prediction_hash
 
 
+    @Instrument.timed('oracle_predict')
     def oracle_predict(self):
         """
         Provides the oracle prediction, calculating the majority vote for each referent.
         """
-        or_prediction_hash = {}
+        self.count_types()
+        self.or_prediction_hash = {}
         for supertype in self.observed_hash:
-            or_prediction_hash[supertype] = {}
+            self.or_prediction_hash[supertype] = {}
             for subtype in self.observed_hash[supertype]:
-                or_prediction_hash[supertype][subtype] = {}
-                # Stores the counts for each abstract size type
-                abs_obs_hash = {}
-                # list of observed abstract size types for a referent.
-                for expression in self.observed_hash[supertype][subtype]:
-                    # Oracle predicted by mod *type* across expressions, not *token*.
-                    # No expression is weighted more...no, it is, because a person who produces 3 different ones gets 3 votes.
-                    for abs_obs in self.get_types(self.observed_hash[supertype][subtype][expression]):
-                        #print abs_obs
-                        try:
-                            abs_obs_hash[abs_obs] += 1
-                        except KeyError:
-                            abs_obs_hash[abs_obs] = 1
-                maj_abs_obs = None
-                maj_num = 0
-                for abs_obs in abs_obs_hash:
-                    num = abs_obs_hash[abs_obs]
-                    if num > maj_num:
-                        maj_num = abs_obs_hash[abs_obs]
-                        maj_abs_obs = abs_obs
                 # Makes oracle prediction (observed majority vote).
-                or_prediction_hash[supertype][subtype] = [maj_abs_obs]
-        return or_prediction_hash
+                self.or_prediction_hash[supertype][subtype] = [self.majority(self.type_counts[supertype][subtype])]
+        return self.or_prediction_hash
 
 
+    @Instrument.timed('maj_predict')
     def maj_predict(self):
         """
         Provides the simple majority prediction, calculating the majority vote for the whole domain excluding the referent."
         """
+        self.count_types()
+        self.update_majority()
+        return self.maj_prediction_hash
+
 
-        maj_prediction_hash = {}
+    def update_majority(self):
+        """
+        Recomputes the simple majority prediction of every referent from the
+        count tables, subtracting the referent's own counts from the global ones.
+        Referents with the same counts share one prediction, computed once.
+        """
+        self.maj_prediction_hash = {}
+        self.signatures = {}
+        self.signature_majority = {}
         for supertype in self.observed_hash:
-            maj_prediction_hash[supertype] = {}
+            self.maj_prediction_hash[supertype] = {}
             for subtype in self.observed_hash[supertype]:
-                maj_prediction_hash[supertype][subtype] = {}
-                # Corresponds to a single referent and all responses.
-                # list of observed abstract size types
-                maj_num = 0
-                abs_obs_hash = {}
-                # For all the *other* referents...
-                for supertype_maj in self.observed_hash:
-                    for subtype_maj in self.observed_hash[supertype_maj]:
-                        if supertype_maj == supertype and subtype_maj == subtype:
-                            continue
-                        # For each type of modifier...
-                        for expression in self.observed_hash[supertype_maj][subtype_maj]:
-                            # Majority predicted by *type* across expressions, not *token*.
-                            # No expression is weighted more...no, it is, because a person who produces 3 different ones gets 3 votes.
-                            for abs_obs_maj in self.get_types(self.observed_hash[supertype_maj][subtype_maj][expression]):
-                                # Increment!
-                                try:
-                                    abs_obs_hash[abs_obs_maj] += 1
-                                except KeyError:
-                                    abs_obs_hash[abs_obs_maj] = 1
-                # Now find which mod was the most common
-                maj_abs_obs = None
-                maj_num = 0
-                for abs_obs in abs_obs_hash:
-                    num = abs_obs_hash[abs_obs]
-                    if num > maj_num:
-                        maj_num = abs_obs_hash[abs_obs]
-                        maj_abs_obs = abs_obs
-                maj_prediction_hash[supertype][subtype] = [maj_abs_obs]
-        return maj_prediction_hash
+                signature = frozenset(self.type_counts[supertype][subtype].items())
+                self.signatures.setdefault(signature, set()).add((supertype, subtype))
+                try:
+                    maj_abs_obs = self.signature_majority[signature]
+                except KeyError:
+                    maj_abs_obs = self.signature_majority[signature] = self.other_majority(signature)
+                self.maj_prediction_hash[supertype][subtype] = [maj_abs_obs]
+        return self.maj_prediction_hash
+
+
+    def other_majority(self, signature):
+        # Majority over the global counts minus a referent's own counts.
+        ref_counts = dict(signature)
+        abs_obs_hash = {}
+        for abs_obs in self.global_counts:
+            num = self.global_counts[abs_obs] - ref_counts.get(abs_obs, 0)
+            if num > 0:
+                abs_obs_hash[abs_obs] = num
+        return self.majority(abs_obs_hash)
+
+
+    def majority(self, abs_obs_hash):
+        """
+        Returns the most common modifier type in abs_obs_hash (None if empty).
+        Ties go to the smallest type, so the result does not depend on the
+        order the counts were built in.
+        """
+        maj_abs_obs = None
+        maj_num = 0
+        for abs_obs in abs_obs_hash:
+            num = abs_obs_hash[abs_obs]
+            if num > maj_num or (num == maj_num and abs_obs < maj_abs_obs):
+                maj_num = num
+                maj_abs_obs = abs_obs
+        return maj_abs_obs
+
+
+    def count_types(self):
+        """
+        Builds the modifier type counts for each referent (type_counts) and for
+        the whole domain (global_counts) in one pass over observed_hash.
+        Counted by *type* across expressions, not *token*: a person who
+        produces 3 different ones gets 3 votes.
+        """
+        # Majority groups are rebuilt from the new tables by update_majority.
+        self.signatures = None
+        if isinstance(self.observed_hash, Corpus.Corpus):
+            return self.count_corpus_types()
+        self.type_counts = {}
+        self.global_counts = {}
+        for supertype in self.observed_hash:
+            self.type_counts[supertype] = {}
+            for subtype in self.observed_hash[supertype]:
+                self.type_counts[supertype][subtype] = {}
+                for expression in self.observed_hash[supertype][subtype]:
+                    self.update_counts(supertype, subtype, self.observed_hash[supertype][subtype][expression], 1)
+        return self.type_counts
+
+
+    def count_corpus_types(self):
+        # count_types over a Corpus's arrays.  Each count dict gets its keys
+        # in the order count_types would have added them.
+        corpus = self.observed_hash
+        mod_types = corpus.mod_types
+        num_types = len(mod_types)
+        (ent_refs, ent_exps, ent_codes) = corpus.entries()
+        ref_counts = []
+        self.type_counts = {}
+        for supertype in corpus:
+            self.type_counts[supertype] = {}
+            for subtype in corpus[supertype]:
+                self.type_counts[supertype][subtype] = {}
+                ref_counts += [self.type_counts[supertype][subtype]]
+        (pairs, first, counts) = numpy.unique(ent_refs * num_types + ent_codes, return_index=True, return_counts=True)
+        order = numpy.argsort(first, kind='mergesort')
+        for (pair, num) in zip(pairs[order].tolist(), counts[order].tolist()):
+            ref_counts[pair // num_types][mod_types[pair % num_types]] = num
+        (codes, first, counts) = numpy.unique(ent_codes, return_index=True, return_counts=True)
+        order = numpy.argsort(first, kind='mergesort')
+        self.global_counts = {}
+        for (code, num) in zip(codes[order].tolist(), counts[order].tolist()):
+            self.global_counts[mod_types[code]] = num
+        return self.type_counts
+
+
+    def update_counts(self, supertype, subtype, mods, inc):
+        """
+        Adds (inc=1) or removes (inc=-1) one expression's modifier types
+        to/from the count tables.
+        """
+        ref_counts = self.type_counts[supertype][subtype]
+        for abs_obs in self.get_types(mods):
+            for counts in (ref_counts, self.global_counts):
+                counts[abs_obs] = counts.get(abs_obs, 0) + inc
+                if counts[abs_obs] == 0:
+                    del counts[abs_obs]
+
+
+    def add_expression(self, supertype, subtype, expression, mods):
+        """
+        Adds an annotated expression [(mod_type, polarity) ...] for a referent,
+        updating the count tables, oracle and majority predictions in place.
+        """
+        if self.type_counts is None:
+            self.count_types()
+        observed = self.observed_hash.setdefault(supertype, {}).setdefault(subtype, {})
+        old_signature = frozenset(self.type_counts.setdefault(supertype, {}).setdefault(subtype, {}).items())
+        if expression in observed:
+            self.update_counts(supertype, subtype, observed[expression], -1)
+        observed[expression] = mods
+        self.update_counts(supertype, subtype, mods, 1)
+        self.update_referent(supertype, subtype, old_signature)
+
+
+    def remove_expression(self, supertype, subtype, expression):
+        """
+        Removes an annotated expression for a referent, updating the count
+        tables, oracle and majority predictions in place.
+        """
+        if self.type_counts is None:
+            self.count_types()
+        old_signature = frozenset(self.type_counts[supertype][subtype].items())
+        mods = self.observed_hash[supertype][subtype].pop(expression)
+        self.update_counts(supertype, subtype, mods, -1)
+        self.update_referent(supertype, subtype, old_signature)
+        return mods
+
+
+    def update_referent(self, supertype, subtype, old_signature):
+        # The referent's oracle prediction depends only on its own counts.
+        # The majority predictions depend on the global counts, so each group
+        # of referents with the same counts gets its prediction recomputed
+        # (one pass over the groups, not the referents), and only the
+        # referents whose prediction changes are rewritten.
+        ref_counts = self.type_counts[supertype][subtype]
+        self.or_prediction_hash.setdefault(supertype, {})[subtype] = [self.majority(ref_counts)]
+        if self.signatures is None:
+            self.update_majority()
+            return None
+        referent = (supertype, subtype)
+        group = self.signatures.get(old_signature)
+        if group is not None:
+            group.discard(referent)
+            if not group:
+                del self.signatures[old_signature]
+                del self.signature_majority[old_signature]
+        signature = frozenset(ref_counts.items())
+        self.signatures.setdefault(signature, set()).add(referent)
+        for other_signature in self.signatures:
+            maj_abs_obs = self.other_majority(other_signature)
+            if other_signature in self.signature_majority and self.signature_majority[other_signature] == maj_abs_obs:
+                continue
+            self.signature_majority[other_signature] = maj_abs_obs
+            for (other_supertype, other_subtype) in self.signatures[other_signature]:
+                self.maj_prediction_hash.setdefault(other_supertype, {})[other_subtype] = [maj_abs_obs]
+        self.maj_prediction_hash.setdefault(supertype, {})[subtype] = [self.signature_majority[signature]]
+        return None
 
 
     def size_mod(self, rx, ry, dx, dy):
         """
         Input:  Referent's height and width (ry, rx)
                 Distractor's height and width (dy, dx)
+        The decision itself is made by decide, through the decision cache
+        if there is one; H1 cases then draw from self.random as calc_ratio does.
+        """
+        if self.cache is None:
+            (branch, mod, pol, val, tie) = self.decide(rx, ry, dx, dy)
+        else:
+            key = self.cache_key(rx, ry, dx, dy)
+            decision = self.cache.get(key)
+            if decision is None:
+                decision = self.cache.put(key, self.decide(*key))
+            elif decision[4]:
+                # decide warned when it made the decision; so does every reuse.
+                Instrument.warn(self.instrument, 'H3 tie', TIE_WARNING)
+            (branch, mod, pol, val, tie) = decision
+        if self.instrument is not None:
+            self.instrument.count(branch)
+        if branch == 'H1':
+            (mod, pol) = self.sample_ratio(val, mod[1], pol)
+        return (mod, pol)
+
+
+    def decide(self, rx, ry, dx, dy):
+        """
+        The deterministic part of size_mod: returns (branch, mod, pol, val, tie).
+        For H1, mod is ('ind', axis) and val is its ratio_val; otherwise
+        val is None.  tie is whether this is an H3 case whose differences
+        tie, for which largest_dim_diff guesses 'y' (and warns).
         """
         (mod, pol) = (None, None)
+        val = None
         if ry > dy:
             # H2
             if rx > dx:
-                (mod, pol) = ('over', 1)
+                (branch, (mod, pol)) = ('H2', ('over', 1))
             # H3
             elif rx < dx:
-                (mod, pol) = self.largest_dim_diff(rx, ry, dx, dy)
+                (branch, (mod, pol)) = ('H3', self.largest_dim_diff(rx, ry, dx, dy))
             # H1 ; rx == dx
             else:
-                (mod, pol) = self.calc_ratio(rx, ry, dx, dy, 'y', 1)
+                (branch, (mod, pol)) = ('H1', (('ind', 'y'), 1))
         elif ry < dy:
             # H2
             if rx < dx:
-                (mod, pol) = ('over', 0)
+                (branch, (mod, pol)) = ('H2', ('over', 0))
             # H3
             elif rx > dx:
-                (mod, pol) = self.largest_dim_diff(rx, ry, dx, dy)
+                (branch, (mod, pol)) = ('H3', self.largest_dim_diff(rx, ry, dx, dy))
             # H1 ; rx == dx
             else:
-                (mod, pol) = self.calc_ratio(rx, ry, dx, dy, 'y', 0)
+                (branch, (mod, pol)) = ('H1', (('ind', 'y'), 0))
         # H1 ; ry == dy
         elif rx > dx:
-            (mod, pol) = self.calc_ratio(rx, ry, dx, dy, 'x', 1)
+            (branch, (mod, pol)) = ('H1', (('ind', 'x'), 1))
         # H1 ; ry == dy
         elif rx < dx:
-            (mod, pol) = self.calc_ratio(rx, ry, dx, dy, 'x', 0)
+            (branch, (mod, pol)) = ('H1', (('ind', 'x'), 0))
         else:
             # Changed 31.July.2012.  Removed this line below so it would stop babbling at me. 
             # sys.stderr.write("Don't know what to do!  height and width identical -- " + str(rx) + ", " + str(ry) + "\n")
-            pass
-        return (mod, pol)
+            branch = 'same size'
+        if branch == 'H1':
+            val = self.ratio_val(rx, ry)
+        tie = branch == 'H3' and abs(ry - dy) == abs(rx - dx)
+        return (branch, mod, pol, val, tie)
+
+
+    def cache_key(self, rx, ry, dx, dy):
+        # Dimensions rounded to the nearest multiple of self.quantum, if set.
+        if self.quantum is None:
+            return (rx, ry, dx, dy)
+        return tuple([quantize(v, self.quantum) for v in (rx, ry, dx, dy)])
+
+
+    def size_mod_batch(self, rx, ry, dx, dy, expectation=False):
+        """
+        Vectorized size_mod over arrays of referent/distractor widths/heights.
+        Input:  Arrays of referent widths and heights (rx, ry)
+                Arrays of distractor widths and heights (dx, dy)
+        Returns (mods, pols): mods holds indices into MOD_TYPES,
+        pols holds the polarity (NO_POL where no prediction is made).
+        H1 cases draw from self.random.randint in input order, exactly as
+        a loop over size_mod would.  With expectation=True, H1 cases are not
+        sampled: they predict ('ind', axis), and a third array vals holds
+        the probability of each prediction in percent (see ratio_val);
+        the alternative to ('ind', axis) is 'over' with the same polarity.
+        Decisions go through the decision cache, if there is one.
+        """
+        if self.cache is None:
+            (mods, pols, vals, h1, ties) = self.decide_batch(rx, ry, dx, dy)
+        else:
+            (mods, pols, vals, h1, ties) = self.cached_batch(rx, ry, dx, dy)
+        Instrument.warn(self.instrument, 'H3 tie', TIE_WARNING, numpy.count_nonzero(ties))
+        if self.instrument is not None:
+            over = (mods == MOD_CODES['over']) & ~h1
+            same = pols == NO_POL
+            self.instrument.count('H1', numpy.count_nonzero(h1))
+            self.instrument.count('H2', numpy.count_nonzero(over))
+            self.instrument.count('H3', mods.size - numpy.count_nonzero(h1 | over | same))
+            self.instrument.count('same size', numpy.count_nonzero(same))
+        if expectation:
+            return (mods, pols, vals)
+        if h1.any():
+            rand_nums = numpy.array([self.random.randint(1, 100) for n in range(numpy.count_nonzero(h1))])
+            mods[h1] = numpy.where(rand_nums <= vals[h1], mods[h1], MOD_CODES['over'])
+            if self.instrument is not None:
+                n_ind = numpy.count_nonzero(rand_nums <= vals[h1])
+                self.instrument.count('H1 ind', n_ind)
+                self.instrument.count('H1 over', len(rand_nums) - n_ind)
+        return (mods, pols)
+
+
+    def decide_batch(self, rx, ry, dx, dy):
+        """
+        Vectorized decide: returns (mods, pols, vals, h1, ties), where H1
+        cases (marked in h1) predict ('ind', axis), vals holds their ratio_val
+        (100 elsewhere) and ties marks the H3 ties guessed as 'y'; see
+        size_mod_batch, which warns about the ties.
+        """
+        rx = numpy.asarray(rx, dtype=float)
+        ry = numpy.asarray(ry, dtype=float)
+        dx = numpy.asarray(dx, dtype=float)
+        dy = numpy.asarray(dy, dtype=float)
+        mods = numpy.zeros(rx.shape, dtype=numpy.int8)
+        pols = numpy.empty(rx.shape, dtype=numpy.int8)
+        pols.fill(NO_POL)
+        y_gt = ry > dy
+        y_lt = ry < dy
+        x_gt = rx > dx
+        x_lt = rx < dx
+        # H2
+        over = (y_gt & x_gt) | (y_lt & x_lt)
+        mods[over] = MOD_CODES['over']
+        pols[over] = y_gt[over]
+        # H3 ; see largest_dim_diff.  Heights always differ here,
+        # so a tie in the differences resolves to 'y'.
+        h3 = (y_gt & x_lt) | (y_lt & x_gt)
+        y_diff = numpy.abs(ry - dy)
+        x_diff = numpy.abs(rx - dx)
+        h3_y = h3 & (y_diff >= x_diff)
+        h3_x = h3 & (y_diff < x_diff)
+        mods[h3_y] = MOD_CODES[('ind', 'y')]
+        pols[h3_y] = y_gt[h3_y]
+        mods[h3_x] = MOD_CODES[('ind', 'x')]
+        pols[h3_x] = x_gt[h3_x]
+        ties = h3 & (y_diff == x_diff)
+        # H1 ; see calc_ratio.
+        h1_y = (y_gt | y_lt) & (rx == dx)
+        h1_x = (ry == dy) & (x_gt | x_lt)
+        h1 = h1_y | h1_x
+        vals = numpy.empty(rx.shape, dtype=numpy.int8)
+        vals.fill(100)
+        if h1.any():
+            greater = numpy.maximum(rx[h1], ry[h1])
+            smaller = numpy.minimum(rx[h1], ry[h1])
+            # Zero dimensions as in ratio_val.
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                prob_ind = numpy.minimum(greater / smaller - 1, 1)
+            prob_ind[smaller == 0] = numpy.where(greater[smaller == 0] > 0, 1, 0)
+            # Rounds half away from zero, as the builtin round does.
+            val = numpy.floor(100 * prob_ind + 0.5)
+            ind_codes = numpy.where(h1_y[h1], MOD_CODES[('ind', 'y')], MOD_CODES[('ind', 'x')])
+            pols[h1] = numpy.where(h1_y[h1], y_gt[h1], x_gt[h1])
+            mods[h1] = ind_codes
+            vals[h1] = val
+        return (mods, pols, vals, h1, ties)
+
+
+    def cached_batch(self, rx, ry, dx, dy):
+        # decide_batch through self.cache: one lookup per distinct (rounded)
+        # set of dimensions, and one decide_batch over those not cached.
+        dims = [numpy.asarray(v, dtype=float) for v in (rx, ry, dx, dy)]
+        shape = dims[0].shape
+        if self.quantum is not None:
+            dims = [quantize_array(v, self.quantum) for v in dims]
+        rows = {}
+        for (n, key) in enumerate(zip(*[v.ravel().tolist() for v in dims])):
+            rows.setdefault(key, []).append(n)
+        decisions = {}
+        missing = []
+        for key in rows:
+            decision = self.cache.get(key, len(rows[key]))
+            if decision is None:
+                missing += [key]
+            else:
+                decisions[key] = decision
+        if missing:
+            (mods, pols, vals, h1, ties) = self.decide_batch(*numpy.array(missing, dtype=float).T)
+            for (key, code, pol, val, is_h1, tie) in zip(missing, mods.tolist(), pols.tolist(), vals.tolist(), \
+                                                         h1.tolist(), ties.tolist()):
+                if is_h1:
+                    branch = 'H1'
+                elif pol == NO_POL:
+                    (branch, pol) = ('same size', None)
+                elif MOD_TYPES[code] == 'over':
+                    branch = 'H2'
+                else:
+                    branch = 'H3'
+                if not is_h1:
+                    val = None
+                decisions[key] = self.cache.put(key, (branch, MOD_TYPES[code], pol, val, tie))
+        mods = numpy.zeros(dims[0].size, dtype=numpy.int8)
+        pols = numpy.empty(dims[0].size, dtype=numpy.int8)
+        vals = numpy.empty(dims[0].size, dtype=numpy.int8)
+        h1 = numpy.zeros(dims[0].size, dtype=bool)
+        ties = numpy.zeros(dims[0].size, dtype=bool)
+        for key in rows:
+            (branch, mod, pol, val, tie) = decisions[key]
+            mods[rows[key]] = MOD_CODES[mod]
+            pols[rows[key]] = NO_POL if pol is None else pol
+            vals[rows[key]] = 100 if val is None else val
+            h1[rows[key]] = branch == 'H1'
+            ties[rows[key]] = tie
+        return (mods.reshape(shape), pols.reshape(shape), vals.reshape(shape), h1.reshape(shape), ties.reshape(shape))
+
+
+    def size_mod_set(self, rx, ry, dx, dy):
+        """
+        Set-based size_mod: one decision for a referent against all of its
+        distractors, with arrays of distractor widths and heights (dx, dy).
+        Returns the (mod, pol) whose KB.Size lemma distinguishes the referent
+        from every distractor, or (None, None):
+            taller and wider than all (or shorter and narrower):  'over'
+            otherwise, beyond all of them on one axis:  ('ind', axis)
+        If the referent is beyond all of them on both axes in opposite
+        directions, the axis with the larger margin is used, as in
+        largest_dim_diff.
+        """
+        (mods, pols) = self.size_mod_set_batch([rx], [ry], numpy.sort(dx), numpy.sort(dy))
+        return self.decode_batch(mods, pols)[0]
+
+
+    def size_mod_set_batch(self, rx, ry, sorted_dx, sorted_dy):
+        """
+        size_mod_set for arrays of referents against the same distractors,
+        whose widths and heights are given sorted; O(log n) per referent.
+        """
+        rx = numpy.asarray(rx, dtype=float)
+        ry = numpy.asarray(ry, dtype=float)
+        n = len(sorted_dx)
+        if n == 0:
+            return self.choose_set_mods(*([numpy.zeros(rx.shape, dtype=bool)] * 4 + [None, None]))
+        # Beyond all distractors: none at or above (below) the referent.
+        tall = numpy.searchsorted(sorted_dy, ry, 'left') == n
+        short = numpy.searchsorted(sorted_dy, ry, 'right') == 0
+        fat = numpy.searchsorted(sorted_dx, rx, 'left') == n
+        thin = numpy.searchsorted(sorted_dx, rx, 'right') == 0
+        y_margin = numpy.where(tall, ry - sorted_dy[-1], sorted_dy[0] - ry)
+        x_margin = numpy.where(fat, rx - sorted_dx[-1], sorted_dx[0] - rx)
+        return self.choose_set_mods(tall, short, fat, thin, y_margin, x_margin)
+
+
+    def size_mod_all(self, widths, heights):
+        """
+        size_mod_set for every object of a scene against all the others,
+        from one sort of the widths and heights.
+        """
+        widths = numpy.asarray(widths, dtype=float)
+        heights = numpy.asarray(heights, dtype=float)
+        n = len(widths)
+        if n < 2:
+            return self.choose_set_mods(*([numpy.zeros(n, dtype=bool)] * 4 + [None, None]))
+        xs = numpy.sort(widths)
+        ys = numpy.sort(heights)
+        # Counts of the *other* objects at or above (below) each object.
+        tall = n - numpy.searchsorted(ys, heights, 'left') - 1 == 0
+        short = numpy.searchsorted(ys, heights, 'right') - 1 == 0
+        fat = n - numpy.searchsorted(xs, widths, 'left') - 1 == 0
+        thin = numpy.searchsorted(xs, widths, 'right') - 1 == 0
+        # Beyond all others, the nearest other is second in sorted order.
+        y_margin = numpy.where(tall, heights - ys[-2], ys[1] - heights)
+        x_margin = numpy.where(fat, widths - xs[-2], xs[1] - widths)
+        return self.choose_set_mods(tall, short, fat, thin, y_margin, x_margin)
+
+
+    def choose_set_mods(self, tall, short, fat, thin, y_margin, x_margin):
+        mods = numpy.zeros(tall.shape, dtype=numpy.int8)
+        pols = numpy.empty(tall.shape, dtype=numpy.int8)
+        pols.fill(NO_POL)
+        y_dist = tall | short
+        x_dist = fat | thin
+        if y_margin is not None:
+            # Both axes, in opposite directions: the larger margin wins, ties to 'y'.
+            both = y_dist & x_dist
+            y_dist = y_dist & ~(both & (y_margin < x_margin))
+            x_dist = x_dist & ~(both & (y_margin >= x_margin))
+        mods[y_dist] = MOD_CODES[('ind', 'y')]
+        pols[y_dist] = tall[y_dist]
+        mods[x_dist] = MOD_CODES[('ind', 'x')]
+        pols[x_dist] = fat[x_dist]
+        over = (tall & fat) | (short & thin)
+        mods[over] = MOD_CODES['over']
+        pols[over] = tall[over]
+        return (mods, pols)
+
+
+    def decode_batch(self, mods, pols):
+        """
+        Turns the (mods, pols) arrays from size_mod_batch back into
+        the (mod, pol) tuples returned by size_mod.
+        """
+        predictions = []
+        for (code, pol) in zip(mods.tolist(), pols.tolist()):
+            if pol == NO_POL:
+                predictions += [(None, None)]
+            else:
+                predictions += [(MOD_TYPES[code], pol)]
+        return predictions
 
 
     def largest_dim_diff(self, rx, ry, dx, dy):
@@ -176,7 +709,7 @@ class SizeAlgorithm():
             elif ry < dy:
                 (mod, pol) = (('ind', 'y'), 0)
             else:
-                sys.stderr.write("Error (this should never happen).\n")
+                Instrument.warn(self.instrument, 'never happens', "Error (this should never happen).\n")
         # if difference in width is greater than difference in height
         elif abs(ry - dy) < abs(rx - dx):
             if rx > dx:
@@ -184,13 +717,13 @@ class SizeAlgorithm():
             elif rx < dx:
                 (mod, pol) = (('ind', 'x'), 0)
             else:
-                sys.stderr.write("Error (this should never happen).\n")
+                Instrument.warn(self.instrument, 'never happens', "Error (this should never happen).\n")
         else: # If the differences between both axes are identical...
             # This part hasn't been figgered yet.
             # Difference in h & w is the same between objects, 
             # just choosing height by default.
             # Later versions should reason about location here.
-            sys.stderr.write("Warning:  Guessing 'y', should randomize?\n")
+            Instrument.warn(self.instrument, 'H3 tie', TIE_WARNING)
             if ry > dy:
                 (mod, pol) = (('ind', 'y'), 1)
             elif ry < dy:
@@ -201,29 +734,55 @@ class SizeAlgorithm():
                 elif rx < dx:
                     (mod, pol) = (('ind', 'x'), 0)
                 else:
-                    sys.stderr.write("Error -- objects have same height and width.\n")
+                    Instrument.warn(self.instrument, 'same height and width', "Error -- objects have same height and width.\n")
         return (mod, pol)
 
     
     def calc_ratio(self, rx, ry, dx, dy, axis, polarity):
         # Takes distractor height/width so a later version
         # may reason about ratio diff.
+        return self.sample_ratio(self.ratio_val(rx, ry), axis, polarity)
+
+
+    def sample_ratio(self, val, axis, polarity):
+        # ('ind', axis) with chance val percent (see ratio_val), else 'over'.
+        rand_num = self.random.randint(1,100)
+        if rand_num > val:
+            (mod, pol) = ('over', polarity)
+        else:
+            (mod, pol) = (('ind', axis), polarity)
+        if self.instrument is not None:
+            self.instrument.count('H1 over' if mod == 'over' else 'H1 ind')
+        return (mod, pol)
+
+
+    def calc_ratio_expected(self, rx, ry, dx, dy, axis, polarity):
+        """
+        Expectation version of calc_ratio: returns
+        [((('ind', axis), polarity), p), (('over', polarity), 1 - p)].
+        """
+        prob_ind = self.ratio_val(rx, ry) / 100.0
+        return [((('ind', axis), polarity), prob_ind), (('over', polarity), 1 - prob_ind)]
+
+
+    def ratio_val(self, rx, ry):
+        """
+        Chance in percent that calc_ratio picks ('ind', axis) over 'over',
+        from the referent's height/width ratio.  A referent with one zero
+        dimension gets 100, as the ratio's limit; one with both gets 0.
+        """
         if ry > rx:
             greater = ry
             smaller = rx
         else:
             greater = rx
             smaller = ry
+        if smaller == 0:
+            return 100 if greater > 0 else 0
         prob_ind = ((greater/float(smaller)) - 1) #* weight
         if prob_ind > 1:
             prob_ind = 1
-        val = round(100 * prob_ind)
-        rand_num = random.randint(1,100)
-        if rand_num > val:
-            (mod, pol) = ('over', polarity)
-        else:
-            (mod, pol) = (('ind', axis), polarity)
-        return (mod, pol)
+        return int(round(100 * prob_ind))
 
 
     # Place to add surface forms (not yet called).
@@ -232,112 +791,83 @@ class SizeAlgorithm():
 
 
     def get_types(self, expression):
-        type_hash = {}
-        for mod in expression:
-            try:
-                type_hash[mod] += 1
-            except KeyError:
-                type_hash[mod] = 1
-        return type_hash
+        return mod_type_hash(expression)
 
 
-    def evaluate(self, predictions=None, observed_hash=None):
+    @Instrument.timed('evaluate')
+    def evaluate(self, predictions=None, observed_hash=None, verbose=False):
+        """
+        Precision/recall of predictions against the observed expressions,
+        averaged over expressions.  The per-referent values used for
+        significance testing are kept in self.evaluator; verbose=True
+        prints them.
+        """
         __self_acc__ = False
+        expected = False
         if predictions == None:
             __self_acc__ = True
             predictions = self.prediction_hash
+            if self.expectation:
+                # Expected precision/recall over the H1 outcomes.
+                predictions = self.expected_hash
+                expected = True
         if observed_hash == None:
             observed_hash = self.observed_hash
-        total_prec = 0
-        total_rec = 0
-        total_prec_num = 0
-        total_rec_num = 0
-        num_expressions = 0.0
-        #supertype_prec = 0
-        #supertype_rec = 0
-        #num_supertypes = 0
-        x = 0
-        sig_precision_hash = {}
-        sig_recall_hash = {}
-
-        #print observed_hash.values()[0].keys()
+        self.evaluator = self.accumulate(predictions, observed_hash, expected=expected)
+        (total_prec, total_rec) = self.evaluator.totals()
+        if verbose:
+            self.evaluator.print_sig()
+        if __self_acc__:
+            self.precision = total_prec
+            self.recall = total_rec
+        return (total_prec, total_rec)
+
+
+    def accumulate(self, predictions, observed_hash, evaluator=None, expected=False):
+        """
+        Feeds every referent in observed_hash into an Evaluator (a new one
+        unless given) and returns it.  With expected=True, predictions is
+        in the format of expected_hash.
+        """
+        if evaluator is None:
+            evaluator = Evaluator(instrument=self.instrument)
+        if isinstance(observed_hash, Corpus.Corpus):
+            evaluator.add_corpus(observed_hash, predictions, expected)
+            return evaluator
         for supertype in observed_hash:
-            #print supertype
-            #subtype_prec = 0
-            #subtype_rec = 0
-            #num_subtypes = 0
             for subtype in observed_hash[supertype]:
-                if observed_hash[supertype][subtype] == {}:
-                    sys.stderr.write("Skipping non-size referent...")
-                    continue
-                #print subtype
                 try:
                     prediction = predictions[supertype][subtype]
                 except KeyError:
                     # Making no prediction = making wrong prediction (0.0 precision/recall)
                     prediction = ['None']
-                #total_prec_num = 0
-                #total_rec_num = 0
-                #num_expressions = 0
-                #print prediction
-                num_expressions += len(observed_hash[supertype][subtype])
-                __n_exp_tmp__ = len(observed_hash[supertype][subtype])
-                __exp_rec_tmp__ = 0
-                __exp_prec_tmp__ = 0
-                for p in prediction:
-                    for n in observed_hash[supertype][subtype]:
-                        expression = observed_hash[supertype][subtype][n]
-                        #print p, expression
-                        # Do not include expressions that don't have size in them anyway.
-                        if expression == []:
-                            sys.stderr.write("Skipping non-size expression...")
-                            continue
-                        #print expression
-                        #print prediction, expression
-                        if p in expression:
-                            __tp__ = 1
-                            #print "yay!"
-                        else:
-                            __tp__ = 0
-                            #print "boo!"
-                        __prec_den__ = float(len(self.get_types(prediction))) #1.0
-                        __rec_den__ = float(len(self.get_types(expression)))
-                        #print __prec_den__
-                        #print __tp__, __prec_den__, __rec_den__
-                        __exp_prec__ = __tp__/__prec_den__
-                        __exp_rec__ = __tp__/__rec_den__
-                        #print __exp_rec__
-                        total_prec_num += __exp_prec__
-                        total_rec_num += __exp_rec__
-                        __exp_rec_tmp__ += __exp_rec__
-                        __exp_prec_tmp__ += __exp_prec__
-                x += 1
-                sig_precision_hash[x] = float(__exp_prec_tmp__)/float(__n_exp_tmp__)
-                sig_recall_hash[x] = float(__exp_rec_tmp__)/float(__n_exp_tmp__) #, num_expressions
-                #subtype_prec += total_prec_num / num_expressions
-                #subtype_rec += total_rec_num / num_expressions
-                #if num_expressions > 0:
-                #    num_subtypes += 1
-            #supertype_prec += subtype_prec / num_subtypes
-            #supertype_rec += subtype_rec / num_subtypes 
-            #if num_subtypes > 0:
-            #    num_supertypes += 1
-        #print total_prec_num, total_rec_num
-        total_prec = total_prec_num / num_expressions #supertype_prec / num_supertypes
-        total_rec = total_rec_num / num_expressions #supertype_rec / num_supertypes
-        print "\nPrecision_hash:"
-        for key in sorted(sig_precision_hash):
-            print str(sig_precision_hash[key]) + ",",
-        print "\nRecall_hash:"
-        for key in sorted(sig_recall_hash):
-            print str(sig_recall_hash[key]) + ",",
+                    if expected:
+                        prediction = [(prediction, 100)]
+                if expected:
+                    evaluator.add_expected((supertype, subtype), prediction, observed_hash[supertype][subtype])
+                else:
+                    evaluator.add((supertype, subtype), prediction, observed_hash[supertype][subtype])
+        return evaluator
 
-        if __self_acc__:
-            self.precision = total_prec
-            self.recall = total_rec
-        return (total_prec, total_rec)
+
+    def compare(self, predictions_a, predictions_b, observed_hash=None, resamples=10000, alpha=0.05, seed=None):
+        """
+        Paired bootstrap and approximate randomization tests between two
+        prediction hashes (e.g., from predict, oracle_predict, maj_predict)
+        on the per-referent precision and recall.
+        Returns {'precision': result, 'recall': result}; see Significance.compare.
+        """
+        if observed_hash == None:
+            observed_hash = self.observed_hash
+        evaluator_a = self.accumulate(predictions_a, observed_hash)
+        evaluator_b = self.accumulate(predictions_b, observed_hash)
+        # Precision and recall share the same resamples.
+        (precision, recall) = Significance.compare([evaluator_a.sig_precision, evaluator_a.sig_recall], \
+                                                   [evaluator_b.sig_precision, evaluator_b.sig_recall], resamples, alpha, seed)
+        return {'precision': precision, 'recall': recall}
 
 
+    @Instrument.timed('stats')
     def stats(self):
         prediction_stats = {}
         for supertype in self.prediction_hash:
@@ -351,6 +881,347 @@ class SizeAlgorithm():
         return prediction_stats
 
 
+    def run_stats(self):
+        """
+        Instrumentation counterpart of stats(): decision branch counts,
+        warning counts and stage timings, as
+        {'counts': {event: n}, 'stages': {stage: {'calls', 'wall', 'cpu'}}}
+        (None unless the instance was made with an instrument).
+        """
+        if self.instrument is None:
+            return None
+        return self.instrument.as_dict()
+
+
+    def cache_stats(self):
+        """
+        {'size', 'max_size', 'hits', 'misses', 'evictions'} for the decision
+        cache (None unless the instance was made with a cache_size).
+        """
+        if self.cache is None:
+            return None
+        return self.cache.stats()
+
+
+    @Instrument.timed('run_parallel')
+    def run_parallel(self, workers=None, seed=0, expectation=None):
+        """
+        Runs predict, oracle_predict, maj_predict, evaluate and stats with the
+        corpus sharded by supertype across a pool of worker processes
+        (workers=None uses all cores; workers=1 runs in this process).
+        Each shard seeds its own RNG from (seed, supertype), so results are
+        the same for any number of workers.  expectation defaults to
+        self.expectation; see __init__.
+        Returns {'predict':(precision, recall), 'oracle':..., 'majority':...}
+        and stores the merged predictions, evaluators and prediction stats.
+        """
+        if expectation is None:
+            expectation = self.expectation
+        supertypes = list(self.observed_hash)
+        # Shards hold plain dicts: a Corpus's views hold its map, which does not pickle.
+        shards = [(supertype, {supertype: self.size_hash.get(supertype, {}) if self.size_hash else {}}, \
+                   {supertype: dict(self.observed_hash[supertype].items())}, seed, expectation, \
+                   self.instrument is not None) \
+                  for supertype in supertypes]
+        if workers == 1:
+            pool = None
+            pool_map = map
+        else:
+            pool = multiprocessing.Pool(workers)
+            pool_map = pool.map
+        try:
+            # The majority baseline needs the counts over the whole domain first.
+            self.type_counts = {}
+            self.global_counts = {}
+            for (supertype, shard_counts) in zip(supertypes, pool_map(count_shard, shards)):
+                self.type_counts[supertype] = shard_counts
+                for subtype in shard_counts:
+                    for abs_obs in shard_counts[subtype]:
+                        self.global_counts[abs_obs] = self.global_counts.get(abs_obs, 0) + shard_counts[subtype][abs_obs]
+            results = pool_map(run_shard, [shard + (self.global_counts,) for shard in shards])
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        self.prediction_hash = {}
+        self.or_prediction_hash = {}
+        self.maj_prediction_hash = {}
+        self.evaluators = {'predict': Evaluator(), 'oracle': Evaluator(), 'majority': Evaluator()}
+        self.prediction_stats = {}
+        for (supertype, result) in zip(supertypes, results):
+            (predictions, or_predictions, maj_predictions, evaluators, prediction_stats, instrument) = result
+            self.prediction_hash[supertype] = predictions
+            self.or_prediction_hash[supertype] = or_predictions
+            self.maj_prediction_hash[supertype] = maj_predictions
+            for name in self.evaluators:
+                self.evaluators[name].merge(evaluators[name])
+            for p in prediction_stats:
+                self.prediction_stats[p] = self.prediction_stats.get(p, 0) + prediction_stats[p]
+            if instrument is not None:
+                self.instrument.merge(instrument)
+        accuracy = {}
+        for name in self.evaluators:
+            accuracy[name] = self.evaluators[name].totals()
+        (self.precision, self.recall) = accuracy['predict']
+        self.evaluator = self.evaluators['predict']
+        return accuracy
+
+
+class Evaluator():
+    """
+    Streaming precision/recall accumulator for SizeAlgorithm.evaluate.
+    Consumes one (referent, prediction, expressions) record at a time,
+    where expressions is {expression: [(mod_type, polarity) ... ]}.
+    Totals are kept as integer true-positive counts per denominator, so
+    evaluators over separate shards merge into exactly the same totals.
+    add_expected takes weighted alternative predictions (see
+    SizeAlgorithm.expected_hash); counts are in percent so that these
+    stay integers.
+    With keep_sig=False memory is constant; otherwise the per-referent
+    precision/recall values are kept for significance testing.
+    """
+    def __init__(self, keep_sig=True, instrument=None):
+        self.keep_sig = keep_sig
+        # Instrument.Stats counting skipped referents/expressions, or None.
+        self.instrument = instrument
+        self.num_expressions = 0
+        # {denominator : number of true positives, in percent}
+        self.prec_counts = {}
+        self.rec_counts = {}
+        self.referents = []
+        self.sig_precision = []
+        self.sig_recall = []
+        return None
+
+
+    def add(self, referent, prediction, expressions):
+        return self.add_expected(referent, [(prediction, 100)], expressions)
+
+
+    def add_expected(self, referent, alternatives, expressions):
+        """
+        alternatives is [(prediction, probability in percent) ...].
+        """
+        if expressions == {}:
+            Instrument.warn(self.instrument, 'skipped referent', "Skipping non-size referent...")
+            return None
+        n_exp = len(expressions)
+        self.num_expressions += n_exp
+        exp_prec = 0.0
+        exp_rec = 0.0
+        for (prediction, weight) in alternatives:
+            prec_den = len(mod_type_hash(prediction))
+            for p in prediction:
+                for n in expressions:
+                    expression = expressions[n]
+                    # Do not include expressions that don't have size in them anyway.
+                    if expression == []:
+                        Instrument.warn(self.instrument, 'skipped expression', "Skipping non-size expression...")
+                        continue
+                    if p not in expression:
+                        continue
+                    rec_den = len(mod_type_hash(expression))
+                    self.prec_counts[prec_den] = self.prec_counts.get(prec_den, 0) + weight
+                    self.rec_counts[rec_den] = self.rec_counts.get(rec_den, 0) + weight
+                    exp_prec += weight / (100.0 * prec_den)
+                    exp_rec += weight / (100.0 * rec_den)
+        if self.keep_sig:
+            self.referents += [referent]
+            self.sig_precision += [exp_prec / n_exp]
+            self.sig_recall += [exp_rec / n_exp]
+        return None
+
+
+    def add_corpus(self, corpus, predictions, expected=False):
+        """
+        add (or add_expected, if expected) for each referent of a
+        Corpus.Corpus in turn, with its prediction from predictions (missing
+        ones count as wrong, as in SizeAlgorithm.accumulate).  Predicted
+        modifiers are matched to expressions on the corpus arrays, in the
+        same order as add_expected, so no expression is decoded.
+        """
+        num_types = len(corpus.mod_types)
+        num_exps = numpy.diff(corpus.ref_offsets)
+        exp_dens = numpy.diff(corpus.type_offsets)
+        # Expressions without size in them, skipped once per predicted modifier.
+        exp_refs = numpy.repeat(numpy.arange(len(num_exps)), num_exps)
+        empties = numpy.bincount(exp_refs[exp_dens == 0], minlength=len(num_exps))
+        (ent_refs, ent_exps, ent_codes) = corpus.entries()
+        ent_keys = ent_refs * num_types + ent_codes
+        ent_order = numpy.argsort(ent_keys, kind='mergesort')
+        ent_keys = ent_keys[ent_order]
+        num_exps = num_exps.tolist()
+        referents = []
+        # One item per predicted modifier: its referent, (referent, code) key,
+        # weight and precision denominator.
+        item_refs = []
+        item_keys = []
+        item_weights = []
+        item_dens = []
+        for (r, supertype, subtype) in corpus.referents():
+            if num_exps[r] == 0:
+                Instrument.warn(self.instrument, 'skipped referent', "Skipping non-size referent...")
+                continue
+            try:
+                alternatives = predictions[supertype][subtype]
+            except KeyError:
+                alternatives = ['None']
+                if expected:
+                    alternatives = [(alternatives, 100)]
+            if not expected:
+                alternatives = [(alternatives, 100)]
+            referents += [(r, (supertype, subtype))]
+            for (prediction, weight) in alternatives:
+                prec_den = len(mod_type_hash(prediction))
+                for p in prediction:
+                    code = corpus.codes.get(p)
+                    item_refs += [r]
+                    item_keys += [-1 if code is None else r * num_types + code]
+                    item_weights += [weight]
+                    item_dens += [prec_den]
+        item_refs = numpy.array(item_refs, dtype=int)
+        num_skipped = numpy.dot(numpy.bincount(item_refs, minlength=len(num_exps)), empties)
+        if num_skipped:
+            Instrument.warn(self.instrument, 'skipped expression', "Skipping non-size expression...", int(num_skipped))
+        self.num_expressions += sum([num_exps[r] for (r, referent) in referents])
+        # Every (item, expression with the item's modifier) pair, item by
+        # item and then in expression order.
+        item_keys = numpy.array(item_keys, dtype=int)
+        low = numpy.searchsorted(ent_keys, item_keys, 'left')
+        num_matches = numpy.searchsorted(ent_keys, item_keys, 'right') - low
+        match_items = numpy.repeat(numpy.arange(len(item_keys)), num_matches)
+        starts = numpy.cumsum(num_matches) - num_matches
+        match_ents = ent_order[low[match_items] + numpy.arange(len(match_items)) - starts[match_items]]
+        weights = numpy.array(item_weights, dtype=int)[match_items]
+        prec_dens = numpy.array(item_dens, dtype=int)[match_items]
+        rec_dens = exp_dens[ent_exps[match_ents]]
+        for (counts, dens) in ((self.prec_counts, prec_dens), (self.rec_counts, rec_dens)):
+            totals = numpy.bincount(dens, weights=weights)
+            for den in numpy.unique(dens).tolist():
+                counts[den] = counts.get(den, 0) + int(totals[den])
+        if self.keep_sig:
+            ref_matches = numpy.bincount(item_refs[match_items], minlength=len(num_exps)).tolist()
+            prec_vals = (weights / (100.0 * prec_dens)).tolist()
+            rec_vals = (weights / (100.0 * rec_dens)).tolist()
+            start = 0
+            for (r, referent) in referents:
+                end = start + ref_matches[r]
+                # Summed one by one, as add_expected does.
+                self.referents += [referent]
+                self.sig_precision += [sum(prec_vals[start:end], 0.0) / num_exps[r]]
+                self.sig_recall += [sum(rec_vals[start:end], 0.0) / num_exps[r]]
+                start = end
+        return None
+
+
+    def merge(self, other):
+        """
+        Folds in the results of another Evaluator (e.g., from another shard).
+        Per-referent values are appended in order.
+        """
+        self.num_expressions += other.num_expressions
+        for (counts, other_counts) in ((self.prec_counts, other.prec_counts), (self.rec_counts, other.rec_counts)):
+            for den in other_counts:
+                counts[den] = counts.get(den, 0) + other_counts[den]
+        if self.keep_sig:
+            self.referents += other.referents
+            self.sig_precision += other.sig_precision
+            self.sig_recall += other.sig_recall
+        return self
+
+
+    def totals(self):
+        """
+        Returns (precision, recall) averaged over all expressions seen.
+        """
+        total_prec_num = sum([self.prec_counts[den] / (100.0 * den) for den in sorted(self.prec_counts)])
+        total_rec_num = sum([self.rec_counts[den] / (100.0 * den) for den in sorted(self.rec_counts)])
+        num_expressions = float(self.num_expressions)
+        return (total_prec_num / num_expressions, total_rec_num / num_expressions)
+
+
+    def sig_precision_hash(self):
+        return dict(zip(range(1, len(self.sig_precision) + 1), self.sig_precision))
+
+
+    def sig_recall_hash(self):
+        return dict(zip(range(1, len(self.sig_recall) + 1), self.sig_recall))
+
+
+    def print_sig(self):
+        print "\nPrecision_hash:"
+        print " ".join([str(val) + "," for val in self.sig_precision]),
+        print "\nRecall_hash:"
+        print " ".join([str(val) + "," for val in self.sig_recall]),
+
+
+def count_shard(shard):
+    """
+    Worker for SizeAlgorithm.run_parallel: modifier type counts for one supertype.
+    """
+    (supertype, size_shard, observed_shard, seed, expectation, instrumented) = shard
+    size_alg = SizeAlgorithm(size_shard, observed_shard)
+    return size_alg.count_types()[supertype]
+
+
+def run_shard(shard):
+    """
+    Worker for SizeAlgorithm.run_parallel: predictions, evaluation and stats
+    for one supertype, given the whole-domain counts for the majority baseline.
+    """
+    (supertype, size_shard, observed_shard, seed, expectation, instrumented, global_counts) = shard
+    # Dict order can change when the shard is pickled, and with the hash seed;
+    # iterating in sorted order fixes which referent gets which random draw.
+    observed_shard = {supertype: collections.OrderedDict(sorted(observed_shard[supertype].items()))}
+    instrument = None
+    if instrumented:
+        instrument = Instrument.Stats()
+    size_alg = SizeAlgorithm(size_shard, observed_shard, seed=shard_seed(seed, supertype), expectation=expectation, \
+                             instrument=instrument)
+    try:
+        predictions = size_alg.predict()
+    except SystemExit:
+        # predict exits on a bad size_hash, which would kill a pool worker and
+        # leave pool.map waiting for good; an exception reaches the caller.
+        raise ValueError("Size hash formatted incorrectly for supertype %r" % (supertype,))
+    or_predictions = size_alg.oracle_predict()
+    size_alg.global_counts = global_counts
+    maj_predictions = size_alg.update_majority()
+    evaluators = {}
+    for (name, prediction_hash) in (('oracle', or_predictions), ('majority', maj_predictions)):
+        evaluators[name] = size_alg.accumulate(prediction_hash, observed_shard)
+    if expectation:
+        evaluators['predict'] = size_alg.accumulate(size_alg.expected_hash, observed_shard, expected=True)
+    else:
+        evaluators['predict'] = size_alg.accumulate(predictions, observed_shard)
+    prediction_stats = size_alg.stats()
+    return (predictions[supertype], or_predictions[supertype], maj_predictions[supertype], evaluators, prediction_stats, instrument)
+
+
+def quantize(v, quantum):
+    """
+    v rounded to the nearest multiple of quantum, except that positive
+    values round to at least quantum: a side rounded to 0 would turn a
+    thin object into one with no width.
+    """
+    rounded = math.floor(v / float(quantum) + 0.5) * quantum
+    if v > 0 and rounded < quantum:
+        return float(quantum)
+    return rounded
+
+
+def quantize_array(v, quantum):
+    # quantize over an array.
+    rounded = numpy.floor(v / float(quantum) + 0.5) * quantum
+    return numpy.where((v > 0) & (rounded < quantum), float(quantum), rounded)
+
+
+def shard_seed(seed, supertype):
+    # An integer seed for the shard: random.Random seeds a string from its
+    # hash, which differs between processes under hash randomization.
+    return zlib.crc32("%s:%s" % (seed, supertype)) & 0xffffffff
+
+
 def demo():
     predictions = {"class1":{"type1":1, "type2":1, "type3":1, "type4":1}, \
                    "class2":{"type1":1, "type2":1}, \
@@ -396,7 +1267,7 @@ def demo():
 
 
     size_alg = SizeAlgorithm()
-    accuracy = size_alg.evaluate(predictions, observed_hash)
+    accuracy = size_alg.evaluate(predictions, observed_hash, verbose=True)
     print "Precision, recall:", accuracy
 
 
@@ -0,0 +1,193 @@
+import sys
+import binascii
+import numpy
+
+import KB
+import SizeAlgorithm
+
+###
+### The Visible Objects Algorithm, as detailed in:
+###
+### Mitchell, M. (2012). Generating Descriptions of Visible Objects. University of Aberdeen, PhD Thesis.
+###
+### Attributes are tried in order of preference: the type (head noun), then
+### the object's attributes from least to most typical for its prototype,
+### then size.  An attribute is kept if it rules out a distractor.
+### Distractors are tracked as bitsets (Python ints, bit n = object n) and
+### ruled out by intersecting with an inverted (attribute, value) -> objects
+### index, so no step walks the scene object by object.  algorithm.py keeps
+### the original, one-referent implementation (Refer).
+###
+### python VisibleObjects.py     (describes a small demo scene)
+###
+
+# Features that are not description attributes; height and width feed size.
+SIZE_FEATURES = ('height', 'width')
+
+
+class VisibleObjects():
+    def __init__(self, scene, prototypes=None, implications=None):
+        """
+        scene is a ReadVector scene, {obj_id: {feature: value}} or a Scene.
+        prototypes is a KB.Prototypes, used to prefer atypical attributes.
+        implications is a KB.Implications; attributes implied by the
+        object's other attributes are tried last.
+        """
+        self.scene = scene
+        self.prototypes = prototypes
+        self.implications = implications
+        self.size_alg = SizeAlgorithm.SizeAlgorithm()
+        # {bitset of objects : size expressions within that group}
+        self.group_sizes = {}
+        self.ids = list(scene)
+        self.rows = dict((obj_id, n) for (n, obj_id) in enumerate(self.ids))
+        self.all = (1 << len(self.ids)) - 1
+        # {(att, val) : bitset of objects with that value}
+        self.index = {}
+        self.attributes = []
+        self.sizes = []
+        rows = {}
+        for (n, obj_id) in enumerate(self.ids):
+            obj = scene[obj_id]
+            atts = {}
+            for (feature, value) in obj.items():
+                if feature in SIZE_FEATURES or isinstance(value, dict):
+                    continue
+                atts[feature] = value
+                rows.setdefault((feature, value), []).append(n)
+            self.attributes += [atts]
+            try:
+                self.sizes += [(float(obj['width']), float(obj['height']))]
+            except KeyError:
+                self.sizes += [None]
+        for att_val in rows:
+            self.index[att_val] = bitset(rows[att_val], len(self.ids))
+        # {att : prototype probability} per object, scored in one batch; empty
+        # for objects without a type or whose type has no prototype.
+        self.scores = [{} for atts in self.attributes]
+        if prototypes is not None:
+            (self.scores, atypical) = prototypes.compile_matrix().typicality(self.attributes)
+
+    def preferred(self, n):
+        """
+        The attributes of object n in order of preference.
+        """
+        atts = self.attributes[n]
+        order = sorted([att for att in atts if att != 'type'])
+        scores = self.scores[n]
+        if scores:
+            # Least typical first; attributes the prototype lacks keep sorted order after them.
+            order = sorted(order, key=lambda att: (att not in scores, scores.get(att, 0.0)))
+        if self.implications is not None:
+            implied = self.implications.implied(atts)
+            order = [att for att in order if att not in implied] + [att for att in order if att in implied]
+        if 'type' in atts:
+            order = ['type'] + order
+        return order
+
+    def describe(self, obj_id):
+        """
+        Returns (description, distinguishing): description is a list of
+        (attribute, value) pairs, with ('size', lemma) for a size modifier,
+        and distinguishing is whether it rules out every other object.
+        """
+        n = self.rows[obj_id]
+        atts = self.attributes[n]
+        distractors = self.all & ~(1 << n)
+        description = []
+        for att in self.preferred(n):
+            remaining = distractors & self.index[(att, atts[att])]
+            if remaining != distractors or att == 'type':
+                description += [(att, atts[att])]
+                distractors = remaining
+            if distractors == 0:
+                break
+        if distractors != 0:
+            lemma = self.size_lemma(n, distractors)
+            if lemma:
+                description += [('size', lemma)]
+                distractors = 0
+        return (description, distractors == 0)
+
+    def describe_all(self):
+        """
+        {obj_id: (description, distinguishing)} for every object in the scene.
+        """
+        descriptions = {}
+        for obj_id in self.ids:
+            descriptions[obj_id] = self.describe(obj_id)
+        return descriptions
+
+    def size_lemma(self, n, distractors):
+        """
+        The KB.Size lemma that distinguishes object n from every remaining
+        distractor, by the set-based Size Algorithm.  Objects left with the
+        same distractors share one size_mod_all pass over their group.
+        """
+        group = distractors | (1 << n)
+        try:
+            expressions = self.group_sizes[group]
+        except KeyError:
+            expressions = self.group_sizes[group] = self.size_group(group)
+        expression = expressions.get(n, (None, None))
+        if expression[0] is None:
+            return None
+        return KB.Size(expression).lemma
+
+    def size_group(self, group):
+        # {object number : (mod, pol) against the rest of the group}
+        rows = list(members(group))
+        sizes = [self.sizes[m] for m in rows]
+        if None in sizes:
+            return {}
+        sizes = numpy.array(sizes, dtype=float)
+        (mods, pols) = self.size_alg.size_mod_all(sizes[:, 0], sizes[:, 1])
+        return dict(zip(rows, self.size_alg.decode_batch(mods, pols)))
+
+    def realise(self, description):
+        """
+        Surface string for a description, e.g. "the big red sofa".
+        """
+        values = dict(description)
+        words = ["the"]
+        if 'size' in values:
+            words += [values['size']]
+        words += [str(val) for (att, val) in description if att not in ('size', 'type')]
+        if 'type' in values:
+            words += [str(values['type'])]
+        return " ".join(words)
+
+
+def bitset(rows, n):
+    """
+    Bitset of the given object numbers (of n objects), built in one go.
+    """
+    bits = bytearray((n + 7) // 8)
+    for row in rows:
+        bits[row >> 3] |= 1 << (row & 7)
+    bits.reverse()
+    return int(binascii.hexlify(bits) or "0", 16)
+
+
+def members(bits):
+    # Object numbers in a bitset, lowest first.
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
+
+
+def demo():
+    scene = {'obj1': {'type': 'sofa', 'colour': 'red', 'height': '10', 'width': '20'},
+             'obj2': {'type': 'sofa', 'colour': 'red', 'height': '5', 'width': '8'},
+             'obj3': {'type': 'sofa', 'colour': 'white', 'height': '10', 'width': '20'},
+             'obj4': {'type': 'fan', 'colour': 'grey', 'height': '4', 'width': '4'}}
+    engine = VisibleObjects(scene, KB.shared_prototypes())
+    descriptions = engine.describe_all()
+    for obj_id in sorted(descriptions):
+        (description, distinguishing) = descriptions[obj_id]
+        print obj_id, engine.realise(description), distinguishing
+
+
+if __name__ == "__main__":
+    demo()
@@ -0,0 +1,294 @@
+import os
+import copy
+import random
+import shutil
+import tempfile
+import unittest
+import numpy
+
+import KB
+import Corpus
+import Instrument
+import SizeAlgorithm
+
+MOD_TYPES = [('over', 0), ('over', 1), (('ind', 'x'), 0), (('ind', 'x'), 1), (('ind', 'y'), 0), (('ind', 'y'), 1)]
+
+
+def random_corpus(rnd, num_supertypes=3, num_subtypes=4, max_expressions=4):
+    observed_hash = {}
+    for s in range(rnd.randint(1, num_supertypes)):
+        observed_hash["s%d" % s] = {}
+        for t in range(rnd.randint(1, num_subtypes)):
+            expressions = {}
+            for e in range(rnd.randint(0, max_expressions)):
+                expressions[e] = [rnd.choice(MOD_TYPES) for k in range(rnd.randint(0, 3))]
+            observed_hash["s%d" % s][str(t)] = expressions
+    return observed_hash
+
+
+def random_size_hash(rnd, observed_hash):
+    size_hash = {}
+    for supertype in observed_hash:
+        size_hash[supertype] = {}
+        for subtype in observed_hash[supertype]:
+            size_hash[supertype][subtype] = {'referent': (rnd.randint(1, 30), rnd.randint(1, 30)), \
+                                             'distractor': (rnd.randint(1, 30), rnd.randint(1, 30))}
+    return size_hash
+
+
+def reference_majority(abs_obs_hash):
+    # Most common type; ties to the smallest type.
+    best = None
+    for abs_obs in abs_obs_hash:
+        if best is None or (abs_obs_hash[abs_obs], best) > (abs_obs_hash[best], abs_obs):
+            best = abs_obs
+    return best
+
+
+def reference_oracle(observed_hash):
+    predictions = {}
+    for supertype in observed_hash:
+        predictions[supertype] = {}
+        for subtype in observed_hash[supertype]:
+            abs_obs_hash = {}
+            for expression in observed_hash[supertype][subtype]:
+                for abs_obs in set(observed_hash[supertype][subtype][expression]):
+                    abs_obs_hash[abs_obs] = abs_obs_hash.get(abs_obs, 0) + 1
+            predictions[supertype][subtype] = [reference_majority(abs_obs_hash)]
+    return predictions
+
+
+def reference_majority_predictions(observed_hash):
+    # The original loop: for each referent, walks every other referent.
+    predictions = {}
+    for supertype in observed_hash:
+        predictions[supertype] = {}
+        for subtype in observed_hash[supertype]:
+            abs_obs_hash = {}
+            for supertype_maj in observed_hash:
+                for subtype_maj in observed_hash[supertype_maj]:
+                    if supertype_maj == supertype and subtype_maj == subtype:
+                        continue
+                    for expression in observed_hash[supertype_maj][subtype_maj]:
+                        for abs_obs in set(observed_hash[supertype_maj][subtype_maj][expression]):
+                            abs_obs_hash[abs_obs] = abs_obs_hash.get(abs_obs, 0) + 1
+            predictions[supertype][subtype] = [reference_majority(abs_obs_hash)]
+    return predictions
+
+
+class MajorityTest(unittest.TestCase):
+    def test_matches_quadratic_loop(self):
+        for seed in range(300):
+            observed_hash = random_corpus(random.Random(seed))
+            size_alg = SizeAlgorithm.SizeAlgorithm(None, observed_hash)
+            self.assertEqual(size_alg.maj_predict(), reference_majority_predictions(observed_hash), seed)
+            self.assertEqual(size_alg.oracle_predict(), reference_oracle(observed_hash), seed)
+
+    def test_edits_match_fresh_predictions(self):
+        for seed in range(100):
+            rnd = random.Random(seed)
+            observed_hash = random_corpus(rnd)
+            size_alg = SizeAlgorithm.SizeAlgorithm(None, observed_hash)
+            size_alg.oracle_predict()
+            size_alg.maj_predict()
+            for edit in range(20):
+                supertype = rnd.choice(sorted(observed_hash) + ["new"])
+                subtype = str(rnd.randint(0, 4))
+                expressions = observed_hash.get(supertype, {}).get(subtype, {})
+                if expressions and rnd.random() < 0.4:
+                    size_alg.remove_expression(supertype, subtype, rnd.choice(sorted(expressions)))
+                else:
+                    mods = [rnd.choice(MOD_TYPES) for k in range(rnd.randint(0, 3))]
+                    size_alg.add_expression(supertype, subtype, rnd.randint(0, 5), mods)
+                fresh = SizeAlgorithm.SizeAlgorithm(None, copy.deepcopy(observed_hash))
+                self.assertEqual(size_alg.or_prediction_hash, fresh.oracle_predict(), (seed, edit))
+                self.assertEqual(size_alg.maj_prediction_hash, fresh.maj_predict(), (seed, edit))
+                self.assertEqual(size_alg.maj_prediction_hash, reference_majority_predictions(observed_hash), (seed, edit))
+
+
+def random_dims(rnd, n, largest=4):
+    # Small integer sizes, so that ties, equal sides and zero sides all occur.
+    return numpy.array([[rnd.randint(0, largest) for k in range(4)] for m in range(n)], dtype=float)
+
+
+class SizeBatchTest(unittest.TestCase):
+    def test_batch_matches_size_mod(self):
+        for seed in range(50):
+            dims = random_dims(random.Random(seed), 200)
+            (stats, batch_stats) = (Instrument.Stats(), Instrument.Stats())
+            size_alg = SizeAlgorithm.SizeAlgorithm(seed=seed, instrument=stats)
+            batch_alg = SizeAlgorithm.SizeAlgorithm(seed=seed, instrument=batch_stats)
+            expected = [size_alg.size_mod(*row) for row in dims.tolist()]
+            with numpy.errstate(all='raise'):
+                (mods, pols) = batch_alg.size_mod_batch(dims[:, 0], dims[:, 1], dims[:, 2], dims[:, 3])
+            self.assertEqual(batch_alg.decode_batch(mods, pols), expected, seed)
+            self.assertEqual(batch_stats.counts, stats.counts, seed)
+
+    def test_set_matches_single_distractor(self):
+        # Against one distractor, size_mod_set makes size_mod's decision, before H1 sampling.
+        size_alg = SizeAlgorithm.SizeAlgorithm(instrument=Instrument.Stats())
+        for (rx, ry, dx, dy) in random_dims(random.Random(0), 2000).tolist():
+            (branch, mod, pol, val, tie) = size_alg.decide(rx, ry, dx, dy)
+            self.assertEqual(size_alg.size_mod_set(rx, ry, numpy.array([dx]), numpy.array([dy])), (mod, pol))
+
+    def test_all_matches_set(self):
+        size_alg = SizeAlgorithm.SizeAlgorithm()
+        rnd = random.Random(0)
+        for scene in range(200):
+            sizes = random_dims(rnd, rnd.randint(1, 8))[:, :2]
+            (mods, pols) = size_alg.size_mod_all(sizes[:, 0], sizes[:, 1])
+            expected = []
+            for n in range(len(sizes)):
+                others = numpy.delete(sizes, n, axis=0)
+                expected += [size_alg.size_mod_set(sizes[n, 0], sizes[n, 1], others[:, 0], others[:, 1])]
+            self.assertEqual(size_alg.decode_batch(mods, pols), expected, scene)
+
+
+def random_objects(rnd, protohash, n):
+    # Objects mixing their prototype's values with unseen values, attributes
+    # no prototype has, unknown types and missing types.
+    types = sorted(protohash)
+    atts = sorted(set([att for obj_type in types for att in protohash[obj_type] if att != 'type'])) + ['unseen']
+    objects = []
+    for m in range(n):
+        obj_type = rnd.choice(types + ['no-such-type', None])
+        obj = {}
+        if obj_type is not None:
+            obj['type'] = obj_type
+        for att in rnd.sample(atts, rnd.randint(0, 4)):
+            vals = sorted(protohash.get(obj_type, {}).get(att, {})) or ['x']
+            obj[att] = rnd.choice(vals + ['unseen'])
+        objects += [obj]
+    return objects
+
+
+class CacheTest(unittest.TestCase):
+    def run_both(self, dims, **options):
+        # Predictions, counts and cache stats from a size_mod loop and from size_mod_batch.
+        runs = []
+        for batch in (False, True):
+            size_alg = SizeAlgorithm.SizeAlgorithm(seed=0, instrument=Instrument.Stats(), **options)
+            if batch:
+                (mods, pols) = size_alg.size_mod_batch(dims[:, 0], dims[:, 1], dims[:, 2], dims[:, 3])
+                predictions = size_alg.decode_batch(mods, pols)
+            else:
+                predictions = [size_alg.size_mod(*row) for row in dims.tolist()]
+            counts = dict((event, n) for (event, n) in size_alg.instrument.counts.items() if n)
+            runs += [(predictions, counts, size_alg.cache_stats())]
+        return runs
+
+    def test_cached_matches_uncached(self):
+        for seed in range(20):
+            dims = random_dims(random.Random(seed), 300)
+            (expected, batch) = self.run_both(dims)
+            self.assertEqual(batch[:2], expected[:2], seed)
+            for cache_size in (5, 10000):
+                for (predictions, counts, cache_stats) in self.run_both(dims, cache_size=cache_size):
+                    self.assertEqual((predictions, counts), expected[:2], (seed, cache_size))
+
+    def test_quantized_paths_agree(self):
+        for seed in range(20):
+            dims = random_dims(random.Random(seed), 300, 40)
+            (loop, batch) = self.run_both(dims, cache_size=10000, quantum=10)
+            self.assertEqual(loop, batch, seed)
+        size_alg = SizeAlgorithm.SizeAlgorithm(seed=0, cache_size=10, quantum=10)
+        self.assertEqual(size_alg.cache_key(3, 20, 3, 10), (10.0, 20.0, 10.0, 10.0))
+
+    def test_counts_per_row(self):
+        dims = numpy.array([[3, 5, 4, 4]] * 100 + [[1, 2, 3, 4]] * 3, dtype=float)
+        (loop, batch) = self.run_both(dims, cache_size=10)
+        self.assertEqual(batch[2]['hits'], 101)
+        self.assertEqual(batch[2]['misses'], 2)
+        self.assertEqual(loop, batch)
+
+
+class TypicalityTest(unittest.TestCase):
+    def test_matrix_matches_typicality(self):
+        prototypes = KB.shared_prototypes()
+        matrix = prototypes.compile_matrix()
+        for seed in range(20):
+            objects = random_objects(random.Random(seed), prototypes.protohash, 200)
+            expected = ([], [])
+            for obj in objects:
+                if 'type' in obj:
+                    (scores, atypical) = prototypes.typicality(obj)
+                else:
+                    (scores, atypical) = ({}, None)
+                expected[0].append(scores)
+                expected[1].append(atypical)
+            self.assertEqual(matrix.typicality(objects), expected, seed)
+
+
+class ParallelTest(unittest.TestCase):
+    def test_same_for_any_workers(self):
+        rnd = random.Random(0)
+        observed_hash = random_corpus(rnd, 6, 20)
+        size_hash = random_size_hash(rnd, observed_hash)
+        runs = []
+        for workers in (1, 3):
+            size_alg = SizeAlgorithm.SizeAlgorithm(size_hash, observed_hash, instrument=Instrument.Stats())
+            results = size_alg.run_parallel(workers=workers, seed=7)
+            runs += [(results, size_alg.prediction_hash, size_alg.maj_prediction_hash, size_alg.instrument.counts)]
+        self.assertEqual(runs[0], runs[1])
+
+    def test_bad_size_hash_raises(self):
+        observed_hash = random_corpus(random.Random(0))
+        for workers in (1, 2):
+            size_alg = SizeAlgorithm.SizeAlgorithm(None, observed_hash, instrument=Instrument.Stats())
+            self.assertRaises(ValueError, size_alg.run_parallel, workers=workers)
+
+
+class CorpusTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def results(self, size_hash, observed_hash):
+        size_alg = SizeAlgorithm.SizeAlgorithm(size_hash, observed_hash, seed=1, instrument=Instrument.Stats())
+        predictions = size_alg.predict()
+        evaluation = size_alg.evaluate()
+        or_predictions = size_alg.oracle_predict()
+        maj_predictions = size_alg.maj_predict()
+        return (predictions, evaluation, size_alg.evaluate(or_predictions), size_alg.evaluate(maj_predictions), \
+                or_predictions, maj_predictions, size_alg.type_counts, size_alg.global_counts, size_alg.instrument.counts)
+
+    def test_matches_dicts(self):
+        for seed in range(30):
+            rnd = random.Random(seed)
+            observed_hash = random_corpus(rnd, 5, 10)
+            size_hash = random_size_hash(rnd, observed_hash)
+            path = os.path.join(self.tmp_dir, "observed.corpus")
+            Corpus.compile_corpus(observed_hash, path)
+            corpus = Corpus.Corpus(path)
+            self.assertEqual(list(corpus), list(observed_hash), seed)
+            for supertype in observed_hash:
+                self.assertEqual(corpus[supertype].items(), observed_hash[supertype].items(), seed)
+            self.assertEqual(self.results(size_hash, corpus), self.results(size_hash, observed_hash), seed)
+            corpus.close()
+
+    def test_parallel_matches_dicts(self):
+        rnd = random.Random(0)
+        observed_hash = random_corpus(rnd, 5, 10)
+        size_hash = random_size_hash(rnd, observed_hash)
+        path = os.path.join(self.tmp_dir, "observed.corpus")
+        Corpus.compile_corpus(observed_hash, path)
+        corpus = Corpus.Corpus(path)
+        expected = SizeAlgorithm.SizeAlgorithm(size_hash, observed_hash, instrument=Instrument.Stats()).run_parallel(workers=1)
+        for workers in (1, 2):
+            size_alg = SizeAlgorithm.SizeAlgorithm(size_hash, corpus, instrument=Instrument.Stats())
+            self.assertEqual(size_alg.run_parallel(workers=workers), expected, workers)
+
+    def test_arrays_outlive_close(self):
+        path = os.path.join(self.tmp_dir, "observed.corpus")
+        Corpus.compile_corpus(random_corpus(random.Random(0)), path)
+        corpus = Corpus.Corpus(path)
+        (offsets, mods) = (corpus.ref_offsets, corpus.mods)
+        expected = (offsets.tolist(), mods.tolist())
+        corpus.close()
+        self.assertEqual((offsets.tolist(), mods.tolist()), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()